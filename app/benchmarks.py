@@ -0,0 +1,763 @@
+import argparse
+import asyncio
+import contextlib
+import faiss
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import numpy as np
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from functions_ast import extract_chunks, visit_tree
+from functions_ast_query import query_tree
+from functions_callgraph import CallGraph
+from functions_chunkstore import VectorStore
+from functions_embeddings import CustomEmbedding
+from functions_ingestion import iter_cpp_documents
+from config import llm_cfg
+from functions_lexical import tokenize_identifiers
+from functions_llm_request import OllamaLLM, RetrievalEngine
+from functions_parsing import parse_cpp_bytes, parse_cpp_code, reparse_cpp_bytes
+from functions_vectorstore import build_vectorstore, create_index, set_search_params
+
+TEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+PRICING_ENGINE_PATH = os.path.join(TEST_PATH, 'test_parsing', 'finance_pricing_engine.cpp')
+
+
+def timeit(func, repeat: int = 10) -> dict:
+    """
+    Run func `repeat` times, returns best and mean time in milliseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"best_ms": min(times), "mean_ms": sum(times) / len(times)}
+
+
+def quiet(func):
+    """
+    Wrap func so that its prints are discarded.
+    """
+    def wrapper(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def nested_namespaces_code(depth: int) -> str:
+    """
+    Generate C++ code with `depth` nested namespaces around a class.
+    """
+    opening = "".join(f"namespace n{i} {{\n" for i in range(depth))
+    closing = "}\n" * depth
+    body = "class Deep {\npublic:\n    int f() {\n        return g(1);\n    }\n};\n"
+    return opening + body + closing
+
+
+def bench_ast(file_path: str = PRICING_ENGINE_PATH, repeat: int = 50):
+    """
+    Time AST chunk extraction on a source file and on deeply nested generated code.
+    """
+    with open(file_path, 'r') as f:
+        code = f.read()
+    root = parse_cpp_code(code)
+    code_bytes = code.encode("utf-8")
+    chunks = quiet(extract_chunks)(root, code, file_path)
+
+    print(f"{os.path.basename(file_path)}: {len(code.splitlines())} lines, {len(chunks)} chunks")
+    print(f"  parse_cpp_code  {timeit(lambda: parse_cpp_code(code), repeat)}")
+    print(f"  visit_tree      {timeit(lambda: visit_tree(root, code_bytes), repeat)}")
+    print(f"  extract_chunks  {timeit(lambda: quiet(extract_chunks)(root, code, file_path), repeat)}")
+
+    # Deeper than the default Python recursion limit
+    deep_code = nested_namespaces_code(5000)
+    deep_root = parse_cpp_code(deep_code)
+    deep_chunks = quiet(extract_chunks)(deep_root, deep_code, 'deep.cpp')
+    print(f"nested namespaces (depth 5000): {len(deep_chunks)} chunks, "
+          f"namespace length {len(deep_chunks[0].metadata['namespace'])}")
+    print(f"  extract_chunks  {timeit(lambda: quiet(extract_chunks)(deep_root, deep_code, 'deep.cpp'), 3)}")
+
+
+def source_files(folder_path: str = TEST_PATH) -> list:
+    """
+    Returns sorted C/C++ files under folder_path.
+    """
+    return sorted(
+        os.path.join(root, file)
+        for root, dirs, files in os.walk(folder_path)
+        for file in files
+        if file.endswith(('.cc', '.h', '.c', '.cpp', '.hpp'))
+    )
+
+
+def bench_extractors(folder_path: str = TEST_PATH, repeat: int = 50):
+    """
+    Time the visitor and query extractors (test/test_extractors.py checks they give the same chunks).
+    """
+    for file_path in source_files(folder_path):
+        with open(file_path, 'r') as f:
+            code = f.read()
+        code_bytes = code.encode("utf-8")
+        root = parse_cpp_code(code)
+
+        print(f"{os.path.relpath(file_path, folder_path)}: {len(visit_tree(root, code_bytes)[1])} chunks")
+        print(f"  visit_tree  {timeit(lambda: visit_tree(root, code_bytes), repeat)}")
+        print(f"  query_tree  {timeit(lambda: query_tree(root, code_bytes), repeat)}")
+
+
+def bench_reparse(file_path: str = PRICING_ENGINE_PATH, repeat: int = 50):
+    """
+    Compare a full parse with an incremental re-parse after a one line edit.
+    """
+    with open(file_path, 'rb') as f:
+        old_bytes = f.read()
+    middle = old_bytes.index(b'\n', len(old_bytes) // 2) + 1
+    new_bytes = old_bytes[:middle] + b'    int added_line = compute(1);\n' + old_bytes[middle:]
+
+    full_tree = parse_cpp_bytes(new_bytes)
+    incremental_tree = reparse_cpp_bytes(parse_cpp_bytes(old_bytes), old_bytes, new_bytes)
+    assert full_tree.root_node.sexp() == incremental_tree.root_node.sexp(), "incremental tree differs"
+
+    print(f"{os.path.basename(file_path)}: one line inserted, identical trees")
+    print(f"  full parse         {timeit(lambda: parse_cpp_bytes(new_bytes), repeat)}")
+    print(f"  incremental parse  "
+          f"{timeit(lambda: reparse_cpp_bytes(parse_cpp_bytes(old_bytes), old_bytes, new_bytes), repeat)}"
+          f" (includes parsing the old version)")
+    old_trees = [parse_cpp_bytes(old_bytes) for _ in range(repeat)]
+    print(f"  re-parse only      "
+          f"{timeit(lambda: reparse_cpp_bytes(old_trees.pop(), old_bytes, new_bytes), repeat)}")
+
+
+def clustered_vectors(nb_vectors: int, dim: int, nb_clusters: int = 256, seed: int = 0):
+    """
+    Normalized float32 vectors drawn around random centers, closer to embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((nb_clusters, dim)).astype('float32')
+    vectors = centers[rng.integers(0, nb_clusters, nb_vectors)]
+    vectors += 0.5 * rng.standard_normal((nb_vectors, dim)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def bench_ann(nb_vectors: int = 20000, dim: int = 1024, nb_queries: int = 200, k: int = 10):
+    """
+    Recall@k against the flat index, query latency and index size of the approximate index types.
+    """
+    data = clustered_vectors(nb_vectors, dim)
+    queries = clustered_vectors(nb_queries, dim, seed=1)
+
+    flat = create_index(dim, index_type="flat")
+    flat.add(data)
+    start = time.perf_counter()
+    _, truth = flat.search(queries, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / nb_queries
+    print(f"{nb_vectors} vectors of dim {dim}, {nb_queries} queries, recall@{k}")
+    print(f"  {'flat':<10} {'':<14} recall 1.000  {flat_ms:.3f} ms/query  "
+          f"{len(faiss.serialize_index(flat)) / 2**20:.1f} MiB")
+
+    configs = [
+        ("ivf_flat", {"nlist": 256}, "nprobe", [1, 4, 16, 64]),
+        ("ivf_pq", {"nlist": 256, "pq_m": 64, "pq_nbits": 8}, "nprobe", [1, 4, 16, 64]),
+        ("hnsw", {"hnsw_m": 32, "ef_construction": 40}, "ef_search", [16, 64, 256]),
+    ]
+    for index_type, params, knob, values in configs:
+        start = time.perf_counter()
+        index = quiet(create_index)(dim, data, index_type=index_type, **params)
+        index.add(data)
+        build_s = time.perf_counter() - start
+        size = len(faiss.serialize_index(index)) / 2**20
+        for value in values:
+            set_search_params(index, **{knob: value})
+            start = time.perf_counter()
+            _, found = index.search(queries, k)
+            query_ms = (time.perf_counter() - start) * 1000 / nb_queries
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            print(f"  {index_type:<10} {knob + '=' + str(value):<14} recall {recall:.3f}  {query_ms:.3f} ms/query  "
+                  f"{size:.1f} MiB  (build {build_s:.1f}s)")
+
+
+def synthetic_chunks(start: int, count: int) -> list:
+    """
+    Small chunks with the metadata keys of create_chunk.
+    """
+    return [
+        Document(page_content=f"int f{i}(int a) {{\n    return g{i % 97}(a);\n}}", metadata={
+            "file_path": f"src/file_{i // 20}.cpp", "type": "function_definition", "includes": [],
+            "class": None, "namespace": None, "defined_functions": [f"f{i}"], "used_functions": [f"g{i % 97}"],
+            "hash": f"{i:064x}", "start_point": [0, 0], "end_point": [2, 1], "chunk_index": 0, "split_total": 1,
+        })
+        for i in range(start, start + count)
+    ]
+
+
+def bench_insert(sizes=(10000, 100000, 1000000), dim: int = 32, batch_size: int = 10000):
+    """
+    Bulk insertion time of vectors and chunks, per chunk time should not grow with the number of chunks.
+    The previous per-row insertion (id found with list.index) is timed on small batches for comparison.
+    """
+    for nb_chunks in sizes:
+        with tempfile.TemporaryDirectory() as index_path:
+            vector_store = VectorStore.create(index_path, create_index(dim, index_type="flat"))
+            insert_time = 0.0
+            for start in range(0, nb_chunks, batch_size):
+                docs = synthetic_chunks(start, min(batch_size, nb_chunks - start))
+                vectors = clustered_vectors(len(docs), dim, seed=start)
+                begin = time.perf_counter()
+                vector_store.add(vectors, docs)
+                insert_time += time.perf_counter() - begin
+            begin = time.perf_counter()
+            vector_store.save()
+            save_time = time.perf_counter() - begin
+            assert vector_store.chunks.get([nb_chunks - 1])[0].metadata["defined_functions"] == [f"f{nb_chunks - 1}"]
+            vector_store.chunks.close()
+        print(f"  bulk insert {nb_chunks:>8} chunks  {insert_time:.2f}s  "
+              f"{insert_time / nb_chunks * 1e6:.1f} us/chunk  (save {save_time:.2f}s)")
+
+    for nb_chunks in (500, 1000, 2000):
+        with tempfile.TemporaryDirectory() as index_path:
+            vector_store = VectorStore.create(index_path, create_index(dim, index_type="flat"))
+            docs = synthetic_chunks(0, nb_chunks)
+            vectors = clustered_vectors(nb_chunks, dim)
+            begin = time.perf_counter()
+            vector_store.index.add(vectors)
+            for doc in docs:
+                vector_store.chunks.add(vector_store.index.ntotal - len(docs) + docs.index(doc), doc)
+            insert_time = time.perf_counter() - begin
+            vector_store.chunks.close()
+        print(f"  per-row     {nb_chunks:>8} chunks  {insert_time:.2f}s  "
+              f"{insert_time / nb_chunks * 1e6:.1f} us/chunk")
+
+
+def bench_embeddings(backends=("int8", "onnx"), folder_path: str = TEST_PATH, k: int = 5):
+    """
+    Throughput of the quantized embedding backends against the fp32 model on the test corpus chunks,
+    with retrieval agreement: overlap of the top-k chunks of each chunk used as query, and cosine
+    similarity between the fp32 and quantized vectors.
+    """
+    texts = [doc.page_content
+             for docs, _ in quiet(lambda: list(iter_cpp_documents(source_files(folder_path))))()
+             for doc in docs]
+
+    def create_index_with(vectors):
+        index = create_index(vectors.shape[1], index_type="flat")
+        index.add(vectors)
+        return index
+
+    def run(embedding):
+        embedding.embed_documents(texts[:8])  # warm up
+        start = time.perf_counter()
+        documents = np.array(embedding.embed_documents(texts), dtype='float32')
+        documents_s = time.perf_counter() - start
+        start = time.perf_counter()
+        queries = np.array([embedding.embed_query(text) for text in texts], dtype='float32')
+        queries_s = time.perf_counter() - start
+        _, top = create_index_with(documents).search(queries, min(k, len(texts)))
+        return documents, top, documents_s, queries_s
+
+    reference, reference_top, documents_s, queries_s = run(CustomEmbedding(backend="torch"))
+    print(f"{len(texts)} chunks, top-{k} agreement with fp32")
+    print(f"  {'torch':<6} {len(texts) / documents_s:7.1f} docs/s  {len(texts) / queries_s:7.1f} queries/s")
+    for backend in backends:
+        try:
+            embedding = CustomEmbedding(backend=backend)
+        except ImportError as e:
+            print(f"  {backend:<6} skipped ({e})")
+            continue
+        vectors, top, documents_s, queries_s = run(embedding)
+        agreement = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(top, reference_top)])
+        cosine = np.mean(np.sum(vectors * reference, axis=1)
+                         / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1)))
+        print(f"  {backend:<6} {len(texts) / documents_s:7.1f} docs/s  {len(texts) / queries_s:7.1f} queries/s  "
+              f"agreement {agreement:.3f}  cosine {cosine:.4f}")
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for Ollama /api/chat: streams `tokens` parts after `first_token_delay`, one every `token_delay`.
+    """
+    tokens = 50
+    first_token_delay = 0.2
+    token_delay = 0.01
+    sent = []
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        time.sleep(self.first_token_delay)
+        try:
+            for i in range(self.tokens):
+                self._send({"model": request["model"], "message": {"role": "assistant", "content": f"tok{i} "},
+                            "done": False})
+                type(self).sent.append(i)
+                time.sleep(self.token_delay)
+            self._send({"model": request["model"], "message": {"role": "assistant", "content": ""}, "done": True,
+                        "eval_count": self.tokens, "eval_duration": int(self.tokens * self.token_delay * 1e9)})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send(self, part: dict):
+        self.wfile.write(json.dumps(part).encode() + b'\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_llm_stream():
+    """
+    Streamed generation against a local stub of Ollama: time to first token, tokens/s and cancellation
+    (test/test_llm_stream.py checks the streamed answers and stats).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    llm = OllamaLLM(model_name="stub", host=f"http://127.0.0.1:{server.server_address[1]}")
+    try:
+        list(llm.stream_answer("context", "query"))
+        stats = llm.last_stats
+        print(f"  stream        ttft {stats['ttft_s'] * 1000:.0f} ms  {stats['tokens']} tokens  "
+              f"{stats['tokens_per_s']:.0f} tok/s  total {stats['total_s']:.2f}s")
+
+        stop_event = threading.Event()
+        StubOllamaHandler.sent.clear()
+        received = []
+        for token in llm.stream_answer("context", "query", stop_event=stop_event):
+            received.append(token)
+            if len(received) == 5:
+                stop_event.set()
+        time.sleep(0.2)
+        print(f"  cancelled     after {len(received)} tokens, server stopped after {len(StubOllamaHandler.sent)}")
+
+        async def consume():
+            return [token async for token in llm.astream_answer("context", "query")]
+        asyncio.run(consume())
+        stats = llm.last_stats
+        print(f"  async stream  ttft {stats['ttft_s'] * 1000:.0f} ms  {stats['tokens']} tokens  "
+              f"{stats['tokens_per_s']:.0f} tok/s  total {stats['total_s']:.2f}s")
+    finally:
+        server.shutdown()
+
+
+def bench_prefill(nb_rounds: int = 3):
+    """
+    Prefill of repeated queries on the configured Ollama model: instructions and query in a single user
+    message (previous prompt) against a fixed system message with the model kept loaded.
+    Only one token is generated, the time is spent evaluating the prompt.
+    """
+    llm = OllamaLLM()
+    snippets = []
+    for file_path in source_files()[:2]:
+        with open(file_path, 'r') as f:
+            snippets.append(f.read()[:1500])
+    variants = {
+        "user prompt": lambda context, query: dict(messages=[{
+            "role": "user",
+            "content": llm.system_prompt + "\n" + llm.user_template.format(query=query, context=context)
+        }]),
+        "system + keep_alive": lambda context, query: dict(messages=llm.build_messages(context, query),
+                                                           keep_alive=llm.keep_alive),
+    }
+    try:
+        llm.client.list()
+    except Exception as e:
+        print(f"  skipped, no Ollama server at {llm_cfg['HOST']} ({e})")
+        return
+
+    for name, request in variants.items():
+        # Unload the model, each variant starts cold
+        llm.client.generate(model=llm.model_name, keep_alive=0)
+        rows = []
+        for _ in range(nb_rounds):
+            for snippet in snippets:
+                response = llm.client.chat(model=llm.model_name, options={"num_predict": 1},
+                                           **request(context="", query=snippet))
+                rows.append((response['prompt_eval_count'] or 0, (response['prompt_eval_duration'] or 0) / 1e6))
+        first, repeated = rows[0], rows[len(snippets):]
+        print(f"  {name:<20} first: {first[0]} tokens {first[1]:.0f} ms  "
+              f"repeated: {np.mean([r[0] for r in repeated]):.0f} tokens {np.mean([r[1] for r in repeated]):.0f} ms")
+
+
+def bench_callgraph(nb_nodes: int = 100000, nb_edges: int = 1000000, hops: int = 2, nb_queries: int = 200):
+    """
+    k-hop callee expansion of the CSR call graph against networkx on a random graph, with identical results
+    without fan-out bounds. Then caller and callee expansion around a hub called by 5% of the nodes, with
+    and without the bounds.
+    """
+    import networkx as nx
+
+    rng = np.random.default_rng(0)
+    sources = rng.integers(0, nb_nodes, nb_edges)
+    targets = rng.integers(0, nb_nodes, nb_edges)
+    start = time.perf_counter()
+    graph = CallGraph.from_edges(np.arange(nb_nodes), sources, targets)
+    csr_build_s = time.perf_counter() - start
+    start = time.perf_counter()
+    nx_graph = nx.DiGraph()
+    nx_graph.add_edges_from(zip(sources.tolist(), targets.tolist()))
+    nx_build_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as index_path:
+        graph.save(index_path)
+        size = sum(os.path.getsize(os.path.join(index_path, f)) for f in os.listdir(index_path))
+        start = time.perf_counter()
+        graph = CallGraph.load(index_path)
+        load_ms = (time.perf_counter() - start) * 1000
+
+        queries = rng.integers(0, nb_nodes, nb_queries).tolist()
+        for node in queries[:20]:
+            expected = nx.single_source_shortest_path_length(nx_graph, node, cutoff=hops)
+            expected.pop(node)
+            assert graph.expand([node], hops=hops, callers=False, max_fanout=None, max_per_hop=None) == expected, \
+                f"expansion differs for {node}"
+
+        start = time.perf_counter()
+        reached = sum(len(graph.expand([node], hops=hops, callers=False, max_fanout=None, max_per_hop=None))
+                      for node in queries)
+        csr_us = (time.perf_counter() - start) * 1e6 / nb_queries
+        start = time.perf_counter()
+        bounded = sum(len(graph.expand([node], hops=hops, callers=False)) for node in queries)
+        bounded_us = (time.perf_counter() - start) * 1e6 / nb_queries
+        start = time.perf_counter()
+        for node in queries:
+            nx.single_source_shortest_path_length(nx_graph, node, cutoff=hops)
+        nx_us = (time.perf_counter() - start) * 1e6 / nb_queries
+        del graph
+
+    print(f"{nb_nodes} nodes, {nb_edges} edges, {hops}-hop callees, {reached / nb_queries:.0f} nodes reached per query")
+    print(f"  csr       build {csr_build_s:.2f}s  load {load_ms:.1f} ms  {size / 2**20:.1f} MiB  {csr_us:.0f} us/query")
+    print(f"  bounded   {bounded / nb_queries:.0f} nodes reached per query  {bounded_us:.0f} us/query")
+    print(f"  networkx  build {nx_build_s:.2f}s  {nx_us:.0f} us/query")
+
+    # A logging function called by 5% of the chunks: every caller of it is 2 hops from every other
+    callers = rng.choice(nb_nodes, nb_nodes // 20, replace=False)
+    hub_graph = CallGraph.from_edges(np.arange(nb_nodes), np.concatenate([sources, callers]),
+                                     np.concatenate([targets, np.zeros(len(callers), dtype='int64')]))
+    for name, bounds in (("unbounded", dict(max_fanout=None, max_per_hop=None)), ("bounded", {})):
+        start = time.perf_counter()
+        reached = sum(len(hub_graph.expand([int(node)], hops=hops, **bounds)) for node in callers[:nb_queries])
+        elapsed_us = (time.perf_counter() - start) * 1e6 / nb_queries
+        print(f"  hub {name:9s} callers and callees: {reached / nb_queries:.0f} nodes per query  {elapsed_us:.0f} us/query")
+
+
+def synthetic_cpp_project(folder_path: str, nb_units: int = 64, nb_headers: int = 16, nb_methods: int = 20) -> str:
+    """
+    Write a C++ project where each unit includes 4 headers (a class each) and calls their methods.
+    Returns the path of its compile_commands.json.
+    """
+    os.makedirs(os.path.join(folder_path, 'include'))
+    os.makedirs(os.path.join(folder_path, 'src'))
+    for h in range(nb_headers):
+        methods = "".join(f"    int m{m}(int x) const {{ return x * {m} + value_; }}\n" for m in range(nb_methods))
+        with open(os.path.join(folder_path, 'include', f'h{h}.h'), 'w') as f:
+            f.write(f"#pragma once\n#include <vector>\n\nclass C{h} {{\npublic:\n{methods}private:\n"
+                    f"    int value_ = {h};\n}};\n")
+
+    commands = []
+    for u in range(nb_units):
+        headers = [(u + i) % nb_headers for i in range(4)]
+        includes = "".join(f'#include "h{h}.h"\n' for h in headers)
+        calls = " + ".join(f"C{h}().m{(u + h) % nb_methods}(x)" for h in headers)
+        functions = "".join(f"int unit{u}_f{i}(int x) {{\n    std::vector<int> v(x);\n    return {calls} + {i};\n}}\n"
+                            for i in range(10))
+        file_path = os.path.join('src', f'unit{u}.cpp')
+        with open(os.path.join(folder_path, file_path), 'w') as f:
+            f.write(includes + "\n" + functions)
+        commands.append({"directory": folder_path, "file": file_path,
+                         "command": f"c++ -std=c++17 -Iinclude -O2 -c {file_path} -o build/unit{u}.o"})
+
+    compile_commands_path = os.path.join(folder_path, 'compile_commands.json')
+    with open(compile_commands_path, 'w') as f:
+        json.dump(commands, f)
+    return compile_commands_path
+
+
+def bench_clang(nb_units: int = 64, nb_headers: int = 16, workers=None):
+    """
+    Translation units per second of the clang ingestion of a synthetic project by number of workers,
+    every header must be chunked once. Also times the chunking of a large class with and without AST dumps.
+    """
+    from clang.cindex import Index
+    from functions_ast_clang_version import chunk_cursors, iter_clang_results, node_to_string
+
+    workers = workers or (1, max(2, os.cpu_count() or 1))
+    with tempfile.TemporaryDirectory() as folder_path:
+        compile_commands_path = synthetic_cpp_project(folder_path, nb_units, nb_headers)
+        baseline = None
+        for nb_workers in workers:
+            start = time.perf_counter()
+            files = [file_path for results, _ in iter_clang_results(compile_commands_path, nb_workers)
+                     for file_path, _, _, _ in results]
+            elapsed = time.perf_counter() - start
+            assert len(files) == len(set(files)) == nb_units + nb_headers, "files chunked more than once"
+            baseline = baseline or elapsed
+            print(f"  {nb_workers} workers: {nb_units / elapsed:.1f} TU/s, {len(files)} files, "
+                  f"speedup {baseline / elapsed:.1f}x")
+
+    def concat_dump(node, indent_level=0):
+        # Previous implementation, copies the dump of every subtree into its parent
+        result = f"{'  ' * indent_level}{node.kind.name}: {node.spelling}\n"
+        for child in node.get_children():
+            result += concat_dump(child, indent_level + 1)
+        return result
+
+    methods = "".join(f"    int m{m}(int x) {{ return x + {m}; }}\n" for m in range(2000))
+    code = f"class Big {{\npublic:\n{methods}}};\n".encode()
+    tu = Index.create().parse('big.cpp', unsaved_files=[('big.cpp', code)])
+    big = next(c for c in tu.cursor.get_children() if c.spelling == 'Big')
+    assert node_to_string(big) == concat_dump(big), "AST dumps differ"
+    dump = {name: timeit(lambda: func(big), 5)['best_ms']
+            for name, func in (("concat", concat_dump), ("join", node_to_string))}
+    chunking = {ast_dump: timeit(lambda: chunk_cursors([big], code, 'big.cpp', [], ast_dump), 5)['best_ms']
+                for ast_dump in (True, False)}
+    print(f"  2000 method class: AST dump concat {dump['concat']:.0f} ms, join {dump['join']:.0f} ms; "
+          f"chunking with dumps {chunking[True]:.0f} ms, without {chunking[False]:.0f} ms")
+
+
+def generated_header(nb_classes: int, nb_methods: int = 20) -> str:
+    """
+    Template heavy header: classes with enums, typedefs, inline and declared methods, and free functions.
+    """
+    parts = ["#pragma once\n#include <map>\n#include <vector>\n\nnamespace gen {\n"]
+    for c in range(nb_classes):
+        methods = "".join(
+            f"    // Method {m}\n"
+            f"    const std::map<std::string, std::vector<Item<T, {m}>>>& get{m}(const Key<K{m}>& key, int n) const "
+            f"{{ if (n) {{ return lookup(key, n); }} return cache_{m % 4}; }}\n"
+            f"    virtual std::vector<std::pair<int, T*>> list{m}(std::size_t offset = {m}) noexcept;\n"
+            for m in range(nb_methods))
+        parts.append(f"template <typename T, typename K = std::map<int, std::vector<T>>>\n"
+                     f"class Store{c} : public Base<T> {{\npublic:\n"
+                     f"    enum class Mode {{ Read, Write }};\n    using Ptr = std::shared_ptr<Store{c}>;\n"
+                     f"{methods}private:\n    const char* name_ = \"{{store}}\";\n}};\n\n"
+                     f"inline int helper{c}(int x) {{\n    return Store{c}<int>::count(x) + {c};\n}}\n\n")
+    parts.append("}\n")
+    return "".join(parts)
+
+
+def bench_headers(sizes=(50, 200, 800), repeat: int = 3):
+    """
+    Throughput of the regex fallback chunker on large generated headers (it must stay linear),
+    and its function matching against the previous pattern on a statement that never closes.
+    """
+    import re
+    from functions_ast_clang_version import extract_header_chunks, find_functions, match_braces
+
+    for nb_classes in sizes:
+        code = generated_header(nb_classes)
+        chunks = quiet(extract_header_chunks)(code, 'generated.h')
+        best_ms = timeit(lambda: quiet(extract_header_chunks)(code, 'generated.h'), repeat)['best_ms']
+        print(f"  {nb_classes} classes {len(code) / 2**20:.2f} MiB: {len(chunks)} chunks in {best_ms:.0f} ms, "
+              f"{len(code) / 2**20 / best_ms * 1000:.1f} MiB/s")
+
+    # Previous function pattern, each `name(` rescans the rest of the statement for its `)`
+    old_pattern = re.compile(r'(?:inline\s+)?(?:explicit\s+)?(?:[\w:<>]+[\s*&]+)+(\w+)\s*\([^;{]*\)\s*(?:const)?\s*'
+                             r'(?:noexcept)?\s*(?:=\s*0)?\s*(?:override)?\s*(?:final)?\s*(?:;|{[^}]*})')
+    for nb_lines in (500, 1000, 2000):
+        code = "".join(f"Type<K{i}> f{i}(Arg{i} a,\n" for i in range(nb_lines))
+        old_ms = timeit(lambda: old_pattern.findall(code), 1)['best_ms']
+        new_ms = timeit(lambda: find_functions(code, 0, len(code), match_braces(code)), 1)['best_ms']
+        print(f"  unclosed statement of {nb_lines} lines: previous pattern {old_ms:.0f} ms, bounded {new_ms:.1f} ms")
+
+
+class HashEmbedding(Embeddings):
+    """
+    Deterministic stub embedder for offline benchmarks: identifier tokens hashed into `dim` signed buckets.
+    Texts sharing identifiers are close, like with a real model on code.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    def _embed(self, text: str) -> list:
+        vector = np.zeros(self.dim, dtype='float32')
+        for token in tokenize_identifiers(text):
+            digest = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little')
+            vector[digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
+
+
+def synthetic_cpp_tree(folder_path: str, nb_files: int = 200, nb_classes: int = 4, nb_methods: int = 8,
+                       nesting: int = 2, call_density: int = 3, nb_folders: int = 10, seed: int = 0) -> dict:
+    """
+    Write a C++ tree of nb_files files in nb_folders folders: each file has nb_classes classes in
+    `nesting` nested namespaces, each class nb_methods methods calling call_density random methods
+    of the tree. Returns the corpus size (files, lines, bytes).
+    """
+    rng = np.random.default_rng(seed)
+    nb_lines = 0
+    nb_bytes = 0
+    for f in range(nb_files):
+        folder = os.path.join(folder_path, f"module{f % nb_folders}")
+        os.makedirs(folder, exist_ok=True)
+        lines = [f'#include "module{(f + 1) % nb_folders}/file{(f + 1) % nb_files}.h"', "#include <vector>", ""]
+        lines += [f"namespace ns{f}_{level} {{" for level in range(nesting)]
+        for c in range(nb_classes):
+            lines += [f"class File{f}Class{c} {{", "public:"]
+            for m in range(nb_methods):
+                calls = [f"f{t[0]}_c{t[1]}_m{t[2]}(value + {i})" for i, t in enumerate(zip(
+                    rng.integers(0, nb_files, call_density), rng.integers(0, nb_classes, call_density),
+                    rng.integers(0, nb_methods, call_density)))]
+                lines += [f"    int f{f}_c{c}_m{m}(int value) {{",
+                          f"        std::vector<int> items(value % {m + 2});",
+                          *(f"        value += {call};" for call in calls),
+                          "        return value;",
+                          "    }"]
+            lines += ["private:", f"    int state_{c} = {c};", "};", ""]
+        lines += ["}"] * nesting
+        code = "\n".join(lines) + "\n"
+        with open(os.path.join(folder, f"file{f}.cpp"), 'w') as file:
+            file.write(code)
+        nb_lines += len(lines)
+        nb_bytes += len(code)
+    return {"files": nb_files, "lines": nb_lines, "bytes": nb_bytes}
+
+
+def latency_stats(times: list) -> dict:
+    """
+    Mean, p50 and p95 of latencies in seconds, in milliseconds.
+    """
+    times_ms = np.array(times) * 1000
+    return {"mean_ms": float(times_ms.mean()), "p50_ms": float(np.percentile(times_ms, 50)),
+            "p95_ms": float(np.percentile(times_ms, 95))}
+
+
+def bench_e2e(nb_files: int = 200, nb_classes: int = 4, nb_methods: int = 8, nesting: int = 2,
+              call_density: int = 3, nb_queries: int = 100) -> dict:
+    """
+    Time each stage on a synthetic C++ tree, offline on CPU with the stub embedder: parse_cpp_code,
+    extract_chunks, build_vectorstore, then similarity_search and find_contextual_chunks queries.
+    Returns the results (written as JSON with --json).
+    """
+    shape = {"files": nb_files, "classes": nb_classes, "methods": nb_methods, "nesting": nesting,
+             "call_density": call_density}
+    results = {"shape": shape, "stages": {}}
+    stages = results["stages"]
+    with tempfile.TemporaryDirectory() as folder_path:
+        docs_path = os.path.join(folder_path, 'docs')
+        index_path = os.path.join(folder_path, 'index')
+        results["corpus"] = synthetic_cpp_tree(docs_path, nb_files, nb_classes, nb_methods, nesting, call_density)
+        mib = results["corpus"]["bytes"] / 2**20
+
+        sources = []
+        for file_path in source_files(docs_path):
+            with open(file_path, 'rb') as f:
+                sources.append((file_path, f.read()))
+        start = time.perf_counter()
+        roots = [parse_cpp_code(code) for _, code in sources]
+        parse_s = time.perf_counter() - start
+        stages["parse_cpp_code"] = {"seconds": parse_s, "mib_per_s": mib / parse_s}
+
+        start = time.perf_counter()
+        nb_chunks = sum(len(quiet(extract_chunks)(root, code, file_path))
+                        for root, (file_path, code) in zip(roots, sources))
+        chunk_s = time.perf_counter() - start
+        stages["extract_chunks"] = {"seconds": chunk_s, "chunks": nb_chunks, "chunks_per_s": nb_chunks / chunk_s}
+        del roots
+
+        embedding = HashEmbedding()
+        start = time.perf_counter()
+        quiet(build_vectorstore)(docs_path, index_path, os.path.join(folder_path, 'hashes.json'), embedding)
+        build_s = time.perf_counter() - start
+        index_size = sum(os.path.getsize(os.path.join(index_path, f)) for f in os.listdir(index_path))
+        stages["build_vectorstore"] = {"seconds": build_s, "chunks_per_s": nb_chunks / build_s,
+                                       "index_mib": index_size / 2**20}
+
+        engine = quiet(RetrievalEngine)(index_path, embedding=embedding)
+        store = VectorStore.load(index_path, read_only=True)
+        query_ids = np.random.default_rng(0).choice(len(store.chunks), min(nb_queries, len(store.chunks)),
+                                                    replace=False)
+        queries = [chunk.page_content for chunk in store.chunks.get(query_ids.tolist())]
+        search_times, context_times = [], []
+        found = 0
+        for query in queries:
+            start = time.perf_counter()
+            pivot_chunk = engine.similarity_search(query, nb_results=1)[0]
+            search_times.append(time.perf_counter() - start)
+            found += pivot_chunk.page_content == query
+            start = time.perf_counter()
+            engine.find_contextual_chunks(pivot_chunk)
+            context_times.append(time.perf_counter() - start)
+        stages["similarity_search"] = {**latency_stats(search_times), "top1_hit_rate": found / len(queries)}
+        stages["find_contextual_chunks"] = latency_stats(context_times)
+        store.chunks.close()
+
+    print(f"{nb_files} files, {results['corpus']['lines']} lines, {nb_chunks} chunks")
+    for stage, stats in stages.items():
+        print(f"  {stage:<23} " + "  ".join(f"{key} {value:.3g}" for key, value in stats.items()))
+    return results
+
+
+def git_commit() -> str:
+    """
+    Commit of the working tree, None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = {
+    "ast": bench_ast,
+    "reparse": bench_reparse,
+    "extractors": bench_extractors,
+    "ann": bench_ann,
+    "insert": bench_insert,
+    "embeddings": bench_embeddings,
+    "llm_stream": bench_llm_stream,
+    "prefill": bench_prefill,
+    "callgraph": bench_callgraph,
+    "clang": bench_clang,
+    "headers": bench_headers,
+    "e2e": bench_e2e,
+}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Run benchmarks.")
+    arg_parser.add_argument("names", nargs="*", help=f"benchmarks to run among {', '.join(BENCHMARKS)} (default: all)")
+    arg_parser.add_argument("--json", help="write the results of the benchmarks returning some (e2e) to this file")
+    e2e_args = arg_parser.add_argument_group("e2e", "shape of the synthetic C++ tree")
+    e2e_args.add_argument("--files", type=int, dest="nb_files", help="number of files (default: 200)")
+    e2e_args.add_argument("--classes", type=int, dest="nb_classes", help="classes per file (default: 4)")
+    e2e_args.add_argument("--methods", type=int, dest="nb_methods", help="methods per class (default: 8)")
+    e2e_args.add_argument("--nesting", type=int, help="nested namespaces around the classes (default: 2)")
+    e2e_args.add_argument("--call-density", type=int, help="calls in each method (default: 3)")
+    e2e_args.add_argument("--queries", type=int, dest="nb_queries", help="number of queries (default: 100)")
+    args = arg_parser.parse_args()
+    options = {"e2e": {key: value for key, value in vars(args).items()
+                       if key in ("nb_files", "nb_classes", "nb_methods", "nesting", "call_density", "nb_queries")
+                       and value is not None}}
+    for name in args.names:
+        if name not in BENCHMARKS:
+            arg_parser.error(f"unknown benchmark {name}")
+    results = {}
+    for name in args.names or BENCHMARKS:
+        print(f"== {name}")
+        result = BENCHMARKS[name](**options.get(name, {}))
+        if result is not None:
+            results[name] = result
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"commit": git_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "cpu_count": os.cpu_count(), "results": results}, f, indent=2)
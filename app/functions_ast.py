@@ -1,6 +1,9 @@
 import hashlib
+import logging
 from langchain_core.documents import Document
 
+logger = logging.getLogger(__name__)
+
 
 def split_large_chunk(code_str: str, max_lines: int = 20) -> list:
     """
@@ -48,36 +51,58 @@ def create_chunk(node, code_bytes, file_path: str, includes, current_class: str,
     return documents
 
 
-def extract_includes(root_node, code_bytes: bytes):
+def node_text(node, code_bytes: bytes) -> str:
     """
-    Search includes and extract only the dependency name.
+    Decode the source text of a node.
     """
+    return code_bytes[node.start_byte:node.end_byte].decode("utf-8", errors="replace").strip()
 
-    includes = []
 
-    def recurse(node):
-        if node.type == 'preproc_include':
-            # Find the child node that contains the include name
-            found_include = False
-            for child in node.children:
-                if child.type == 'string' or child.type == 'system_lib_string':  # Check for both <...> and "..."
-                    include_name = code_bytes[child.start_byte:child.end_byte].decode("utf-8", errors="replace").strip()
-                    includes.append(include_name)
-                    found_include = True
-                    break 
-            if not found_include:
-                include_text = code_bytes[node.start_byte:node.end_byte].decode("utf-8", errors="replace").strip()
-                parts = include_text.split(maxsplit=1)
-                if len(parts) > 1:  
-                    includes.append(parts[1].strip()) 
-                else :
-                    includes.append(include_text)
-
-        for child in node.children:
-            recurse(child)
-
-    recurse(root_node)
-    return includes
+def node_line_count(node) -> int:
+    """
+    Number of lines spanned by a node, without decoding its text.
+    """
+    return node.end_point[0] - node.start_point[0] + 1
+
+
+def include_name(node, code_bytes: bytes) -> str:
+    """
+    Extract only the dependency name of an include node.
+    """
+    # Find the child node that contains the include name, for both <...> and "..."
+    for child in node.children:
+        if child.type == 'string' or child.type == 'system_lib_string':
+            return node_text(child, code_bytes)
+    parts = node_text(node, code_bytes).split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else parts[0] if parts else ''
+
+
+def called_function_name(node, code_bytes: bytes):
+    """
+    Name of the function called by a call_expression node, including method and constructor calls.
+    """
+    fn_node = node.child_by_field_name('function')
+    if fn_node:
+        return node_text(fn_node, code_bytes)
+    return None
+
+
+def iter_nodes(root_node):
+    """
+    Iterate over all nodes of a tree in pre-order, with an explicit stack.
+    """
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def extract_includes(root_node, code_bytes: bytes):
+    """
+    Search includes and extract only the dependency name.
+    """
+    return [include_name(n, code_bytes) for n in iter_nodes(root_node) if n.type == 'preproc_include']
 
 
 def extract_defined_functions(node, code_bytes):
@@ -94,8 +119,7 @@ def extract_defined_functions(node, code_bytes):
                 None
             )
             if identifier:
-                name = code_bytes[identifier.start_byte:identifier.end_byte].decode("utf-8", errors="replace").strip()
-                defined.append(name)
+                defined.append(node_text(identifier, code_bytes))
     return defined
 
 
@@ -104,135 +128,136 @@ def extract_used_functions(node, code_bytes):
     Search which functions are called in the current chunk, including method calls and constructor calls.
     """
     used = []
-
-    def walk(n):
+    for n in iter_nodes(node):
         if n.type == 'call_expression':
-            fn_node = n.child_by_field_name('function')
-            if fn_node:
-                # Capture a wider range of node types, not just simple identifiers
-                if fn_node.type in (
-                    "identifier",
-                    "scoped_identifier",
-                    "qualified_identifier",
-                    "field_expression",
-                    "template_function",
-                    "template_type",
-                    "operator_name",
-                    "destructor_name",
-                ):
-                    fn_name = code_bytes[fn_node.start_byte:fn_node.end_byte].decode("utf-8", errors="replace").strip()
-                    used.append(fn_name)
-                else:
-                    # fallback: capture anything printable just in case
-                    fn_name = code_bytes[fn_node.start_byte:fn_node.end_byte].decode("utf-8", errors="replace").strip()
-                    used.append(fn_name)
-        for child in n.children:
-            walk(child)
-
-    walk(node)
+            fn_name = called_function_name(n, code_bytes)
+            if fn_name is not None:
+                used.append(fn_name)
     return used
 
 
-def collect_functions(node, code_bytes):
-    defined = []
-    used = []
-
-    def walk(n):
-        if n.type == 'function_definition':
-            defined.extend(extract_defined_functions(n, code_bytes))
-            used.extend(extract_used_functions(n, code_bytes))
-        else:
-            used.extend(extract_used_functions(n, code_bytes))
-        for child in n.children:
-            walk(child)
-
-    walk(node)
-    used_clean = list(set(used) - set(defined))
-    return defined, used_clean
+def unique_used(used: list, defined: list) -> list:
+    """
+    Deduplicate called functions (first occurrence order) and drop the ones defined in the chunk.
+    """
+    defined = set(defined)
+    return [name for name in dict.fromkeys(used) if name not in defined]
 
 
-def extract_chunks(root_node, code: str, file_path: str):
+def visit_tree(root_node, code_bytes: bytes):
     """
-    By browsing the AST, search each chunk to create.
+    Single pass over the AST collecting includes, namespaces, classes, definitions and call sites.
+    Returns (includes, chunk specs), chunk specs being in pre-order and holding:
+    node, type, class, namespace, defined functions and used functions.
     """
 
-    code_bytes = code.encode("utf-8")
-    chunks = []
-    includes = extract_includes(root_node, code_bytes)
-    class_stack = []
+    includes = []
     namespace_stack = []
-
-    def recurse(node, current_class=None):
+    class_stack = []
+    specs = []
+    # Open chunk candidates, receiving calls (and definitions for classes) of their subtree
+    open_specs = []
+    # (node, False) enters a node, (node, True) leaves it
+    stack = [(root_node, False)]
+
+    while stack:
+        node, leaving = stack.pop()
         node_type = node.type
 
-        if node_type == 'namespace_definition':
-            ns_name = None
-            for child in node.children:
-                if child.type == 'namespace_identifier':
-                    ns_name = code_bytes[child.start_byte:child.end_byte].decode("utf-8", errors="replace").strip()
-                    break
+        if leaving:
+            if node_type == 'namespace_definition':
+                namespace_stack.pop()
+                continue
+            if node_type in ('class_specifier', 'struct_specifier'):
+                class_stack.pop()
+            if open_specs and open_specs[-1]["node"] == node:
+                spec = open_specs.pop()
+                spec["used"] = unique_used(spec["used"], spec["defined"])
+            continue
+
+        if node_type == 'call_expression':
+            fn_name = called_function_name(node, code_bytes)
+            if fn_name is not None:
+                for spec in open_specs:
+                    spec["used"].append(fn_name)
+
+        elif node_type == 'preproc_include':
+            includes.append(include_name(node, code_bytes))
+
+        elif node_type == 'namespace_definition':
+            ns_name = next(
+                (node_text(c, code_bytes) for c in node.children if c.type == 'namespace_identifier'),
+                None
+            )
             namespace_stack.append(ns_name)
-            for child in node.children:
-                recurse(child, current_class)
-            namespace_stack.pop()
-
-        elif node_type in ['class_specifier', 'struct_specifier']:
-            class_name = None
-            for child in node.children:
-                if child.type == 'type_identifier':
-                    class_name = code_bytes[child.start_byte:child.end_byte].decode("utf-8", errors="replace").strip()
-                    break
+            stack.append((node, True))
+
+        elif node_type in ('class_specifier', 'struct_specifier'):
+            class_name = next(
+                (node_text(c, code_bytes) for c in node.children if c.type == 'type_identifier'),
+                None
+            )
             class_stack.append(class_name)
-            chunk_code = code_bytes[node.start_byte:node.end_byte].decode("utf-8", errors="replace").strip()
-            if len(chunk_code.splitlines()) >= 5:
-                defined, used = collect_functions(node, code_bytes)
-                docs = create_chunk(
-                    node, code_bytes, file_path, includes,
-                    current_class=class_name,
-                    namespace="::".join(namespace_stack) if namespace_stack else None,
-                    chunk_type=node_type,
-                    defined=defined,
-                    used=used
-                )
-                chunks.extend(docs)
-            for child in node.children:
-                recurse(child, current_class=class_name)
-            class_stack.pop()
+            stack.append((node, True))
+            if node_line_count(node) >= 5:
+                spec = new_spec(node, node_type, class_name, namespace_stack)
+                specs.append(spec)
+                open_specs.append(spec)
 
         elif node_type == 'function_definition':
-            if current_class is None:
-                defined = extract_defined_functions(node, code_bytes)
-                used = extract_used_functions(node, code_bytes)
-                used = list(set(used) - set(defined))
-                chunk_code = code_bytes[node.start_byte:node.end_byte].decode("utf-8", errors="replace").strip()
-                if len(chunk_code.splitlines()) >= 3:
-                    docs = create_chunk(
-                        node, code_bytes, file_path, includes,
-                        current_class=None,
-                        namespace="::".join(namespace_stack) if namespace_stack else None,
-                        chunk_type="function_definition",
-                        defined=defined,
-                        used=used
-                    )
-                    chunks.extend(docs)
-
-        elif node_type in ['enum_specifier', 'type_definition']:
-            chunk_code = code_bytes[node.start_byte:node.end_byte].decode("utf-8", errors="replace").strip()
-            if len(chunk_code.splitlines()) >= 3:
+            defined = extract_defined_functions(node, code_bytes)
+            for spec in open_specs:
+                if spec["type"] in ('class_specifier', 'struct_specifier'):
+                    spec["defined"].extend(defined)
+            current_class = class_stack[-1] if class_stack else None
+            if current_class is None and node_line_count(node) >= 3:
+                spec = new_spec(node, node_type, None, namespace_stack, defined)
+                specs.append(spec)
+                open_specs.append(spec)
+                stack.append((node, True))
+
+        elif node_type in ('enum_specifier', 'type_definition'):
+            if node_line_count(node) >= 3:
                 current_class = class_stack[-1] if class_stack else None
-                docs = create_chunk(
-                    node, code_bytes, file_path, includes,
-                    current_class=current_class,
-                    namespace="::".join(namespace_stack) if namespace_stack else None,
-                    chunk_type=node_type,
-                    used=extract_used_functions(node, code_bytes)
-                )
-                chunks.extend(docs)
-
-        for child in node.children:
-            recurse(child, current_class)
-
-    recurse(root_node)
-    print(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
-    # print(chunks)
+                spec = new_spec(node, node_type, current_class, namespace_stack)
+                specs.append(spec)
+                open_specs.append(spec)
+                stack.append((node, True))
+
+        stack.extend((child, False) for child in reversed(node.children))
+
+    return includes, specs
+
+
+def new_spec(node, chunk_type: str, current_class, namespace_stack: list, defined: list = None) -> dict:
+    return {
+        "node": node,
+        "type": chunk_type,
+        "class": current_class,
+        "namespace": "::".join(ns or "(anonymous)" for ns in namespace_stack) if namespace_stack else None,
+        "defined": defined or [],
+        "used": [],
+    }
+
+
+def extract_chunks(root_node, code, file_path: str, collect=visit_tree):
+    """
+    By browsing the AST, search each chunk to create.
+    `code` is the parsed source, str or UTF-8 bytes.
+    `collect` returns (includes, chunk specs) from the AST, see visit_tree.
+    """
+
+    code_bytes = code.encode("utf-8") if isinstance(code, str) else code
+    includes, specs = collect(root_node, code_bytes)
+    chunks = []
+    for spec in specs:
+        chunks.extend(create_chunk(
+            spec["node"], code_bytes, file_path, includes,
+            current_class=spec["class"],
+            namespace=spec["namespace"],
+            chunk_type=spec["type"],
+            defined=spec["defined"],
+            used=spec["used"]
+        ))
+    logger.debug(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
     return chunks
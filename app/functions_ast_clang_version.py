@@ -1,59 +1,95 @@
-from clang.cindex import Index, CursorKind, Config
+from clang.cindex import Index, CursorKind, Config, TranslationUnit, TranslationUnitLoadError
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
 import hashlib
+import json
+import logging
 from langchain_core.documents import Document
+import multiprocessing
 import os
 import re
+import shlex
+import time
 
-# TODO: Fix CALL_EXPR detection for used functions
-# TODO: Ensure parent_class is always correctly tracked
-# TODO: Factor out common chunk creation logic
+from config import parser_cfg
+from functions_ingestion import new_timings
+
+logger = logging.getLogger(__name__)
+
+# Driver arguments of a compile command that do not change how a file parses (with their value)
+IGNORED_ARGS = {'-c': 0, '-o': 1, '-MD': 0, '-MMD': 0, '-MF': 1, '-MT': 1, '-MQ': 1}
+PARSE_OPTIONS = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+# Chunk kinds -> tree-sitter node types of the same chunks
+CHUNK_TYPES = {"class": "class_specifier", "struct": "struct_specifier", "function": "function_definition",
+               "enum": "enum_specifier", "typedef": "type_definition"}
+# Cursors chunked or descended into by chunk_cursors, checked to be in the chunked file
+CHUNK_CURSOR_KINDS = (CursorKind.NAMESPACE, CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL,
+                      CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD)
 
 
 def create_chunk(code, file_path, chunk_type, extent=None, includes=None, current_class=None,
                  defined=None, used=None, fields=None, ast=None, max_chunk_size=500,
-                 generator="clang"):
+                 generator="clang", namespace=None):
+    """
+    Create chunks with the metadata of the tree-sitter chunks (functions_ast.create_chunk): tree-sitter node
+    types, enclosing class, namespace, split index and 0-based (row, column) points, plus the clang fields.
+    """
 
     chunks = []
     if extent:
         chunk_code = code[extent.start.offset:extent.end.offset].strip()
     else:
         chunk_code = code.strip()
+    if isinstance(chunk_code, bytes):
+        # Extent offsets are byte offsets of the file
+        chunk_code = chunk_code.decode('utf-8', errors='replace')
 
-    def make_doc(sub_code):
+    def make_doc(sub_code, index, total):
         return Document(
             page_content=sub_code,
             metadata={
                 "file_path": file_path,
-                "type": chunk_type,
+                "type": CHUNK_TYPES[chunk_type],
                 "includes": includes or [],
-                "parent_class": current_class,
+                "class": current_class,
+                "namespace": namespace,
                 "defined_functions": defined or [],
                 "used_functions": used or [],
                 "defined_fields": fields or [],
                 "hash": hashlib.sha256(sub_code.encode('utf-8')).hexdigest(),
-                "start_point": (extent.start.line, extent.start.column) if extent else None,
-                "end_point": (extent.end.line, extent.end.column) if extent else None,
+                # Clang lines and columns start at 1, tree-sitter points at 0
+                "start_point": (extent.start.line - 1, extent.start.column - 1) if extent else None,
+                "end_point": (extent.end.line - 1, extent.end.column - 1) if extent else None,
                 "ast": ast,
-                "generated_by": generator
+                "generated_by": generator,
+                "chunk_index": index,
+                "split_total": total
             }
         )
 
     if len(chunk_code) > max_chunk_size:
-        for i in range(0, len(chunk_code), max_chunk_size):
-            sub_chunk = chunk_code[i:i+max_chunk_size].strip()
-            chunks.append(make_doc(sub_chunk))
+        sub_chunks = [chunk_code[i:i+max_chunk_size].strip() for i in range(0, len(chunk_code), max_chunk_size)]
     else:
-        chunks.append(make_doc(chunk_code))
+        sub_chunks = [chunk_code]
+    for i, sub_chunk in enumerate(sub_chunks):
+        chunks.append(make_doc(sub_chunk, i, len(sub_chunks)))
 
     return chunks
 
 
 def node_to_string(node, indent_level=0):
-    indent = "  " * indent_level
-    result = f"{indent}{node.kind.name}: {node.spelling}\n"
-    for child in node.get_children():
-        result += node_to_string(child, indent_level + 1)
-    return result
+    """
+    Indented dump of the AST under node, one `KIND: spelling` line per node.
+    """
+    lines = []
+
+    def visit(n, level):
+        lines.append(f"{'  ' * level}{n.kind.name}: {n.spelling}\n")
+        for child in n.get_children():
+            visit(child, level + 1)
+
+    visit(node, indent_level)
+    return "".join(lines)
 
 
 def extract_defined_and_used_functions(node):
@@ -74,133 +110,471 @@ def extract_defined_and_used_functions(node):
     return list(defined), list(used - defined)
 
 
-def extract_chunks(tu, code: str, file_path: str):
+def chunk_cursors(cursors, code, file_path: str, includes: list, ast_dump: bool = None, directory: str = ''):
+    """
+    Chunks of classes, structs and functions defined under the given cursors of one file.
+    Definitions from other files (a header included inside a namespace) are skipped, they are chunked
+    with their own file.
+    AST dumps are only added to the metadata with ast_dump (config CLANG_AST_DUMP, default False).
+    """
+    if ast_dump is None:
+        ast_dump = parser_cfg.get("CLANG_AST_DUMP", False)
     chunks = []
-    includes = []
+    file_path = os.path.normpath(file_path)
+
+    def recurse(node, current_class=None, namespace=None):
+        if node.kind in CHUNK_CURSOR_KINDS and cursor_file(node, directory) != file_path:
+            return
 
-    def recurse(node, current_class=None):
-        if node.kind == CursorKind.INCLUSION_DIRECTIVE:
-            includes.append(node.spelling)
+        if node.kind == CursorKind.NAMESPACE:
+            # Same namespace path as tree-sitter chunks
+            name = node.spelling or "(anonymous)"
+            namespace = f"{namespace}::{name}" if namespace else name
 
         elif node.kind in [CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL] and node.is_definition():
             fields = [c.spelling for c in node.get_children() if c.kind == CursorKind.FIELD_DECL]
-            ast_str = node_to_string(node)
-            chunks.extend(create_chunk(code, file_path, "class" if node.kind == CursorKind.CLASS_DECL else "struct",
-                                       extent=node.extent, includes=includes, fields=fields, ast=ast_str))
+            ast_str = node_to_string(node) if ast_dump else None
             current_class = node.spelling
+            chunks.extend(create_chunk(code, file_path, "class" if node.kind == CursorKind.CLASS_DECL else "struct",
+                                       extent=node.extent, includes=includes, current_class=current_class,
+                                       fields=fields, ast=ast_str, namespace=namespace))
 
         elif node.kind in [CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD] and node.is_definition():
             defined, used = extract_defined_and_used_functions(node)
-            ast_str = node_to_string(node)
+            ast_str = node_to_string(node) if ast_dump else None
             chunks.extend(create_chunk(code, file_path, "function", extent=node.extent,
                                        includes=includes, current_class=current_class,
-                                       defined=defined, used=used, ast=ast_str))
+                                       defined=defined, used=used, ast=ast_str, namespace=namespace))
 
         for child in node.get_children():
-            recurse(child, current_class)
+            recurse(child, current_class, namespace)
 
-    recurse(tu.cursor)
-    print(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
+    for cursor in cursors:
+        recurse(cursor)
     return chunks
 
 
-def extract_defined_and_used_functions_regex(code: str):
-    FUNC_REGEX = r'\b(?:inline\s+)?(?:explicit\s+)?(?:[\w:<>]+[\s*&]+)+(\w+)\s*\([^;]*?\)\s*(?:const)?\s*(?:noexcept)?\s*(?:=\s*0)?\s*(?:override)?\s*(?:final)?\s*(?:;|{)?'
-    defined = re.findall(FUNC_REGEX, code)
-    used = re.findall(r'\b(?:\w+::)?(\w+)\s*\(', code)
-    return defined, list(set(used) - set(defined))
+def cursor_file(cursor, directory: str = ''):
+    """
+    Normalized path of the file of a cursor, None for builtins.
+    """
+    location_file = cursor.location.file
+    if location_file is None:
+        return None
+    return os.path.normpath(os.path.join(directory, location_file.name))
 
 
-def extract_class_blocks_with_brace_matching(code: str):
-    pattern = re.compile(r'(?:template\s*<[^>]+>\s*)?(class|struct)\s+(\w+)[^{]*{', re.MULTILINE)
-    matches = []
+def extract_chunks(tu, code, file_path: str, ast_dump: bool = None):
+    """
+    Chunks of the main file of a translation unit, code is its content.
+    """
+    includes = []
+    cursors = []
+    for cursor in tu.cursor.get_children():
+        if cursor_file(cursor) != os.path.normpath(file_path):
+            continue
+        if cursor.kind == CursorKind.INCLUSION_DIRECTIVE:
+            includes.append(cursor.spelling)
+        else:
+            cursors.append(cursor)
+    chunks = chunk_cursors(cursors, code, file_path, includes, ast_dump)
+    logger.debug(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
+    return chunks
+
 
+def load_compile_commands(compile_commands_path: str) -> list:
+    """
+    Returns [(source path, clang arguments, directory), ...] of a compile_commands.json.
+    The compiler, output and dependency file arguments are dropped, relative paths are
+    resolved from the directory of each command (-working-directory).
+    """
+    with open(compile_commands_path, 'r') as f:
+        entries = json.load(f)
+
+    commands = []
+    for entry in entries:
+        directory = entry.get('directory', os.path.dirname(os.path.abspath(compile_commands_path)))
+        file_path = os.path.normpath(os.path.join(directory, entry['file']))
+        arguments = entry.get('arguments') or shlex.split(entry['command'])
+        args = []
+        skip = 0
+        for arg in arguments[1:]:
+            if skip:
+                skip -= 1
+            elif arg in IGNORED_ARGS:
+                skip = IGNORED_ARGS[arg]
+            elif arg.startswith('-o') or os.path.normpath(os.path.join(directory, arg)) == file_path:
+                continue
+            else:
+                args.append(arg)
+        commands.append((file_path, args + ['-working-directory', directory], directory))
+    return commands
+
+
+def parse_translation_unit(index, file_path: str, args: list, directory: str, skip_files,
+                           timings: dict, ast_dump: bool = None):
+    """
+    Parse one translation unit and chunk its main file and the headers it includes, except
+    system headers and the files in skip_files (a set or SharedFiles, updated with the chunked files).
+    Returns [(file_path, content hash, encoding, documents), ...] like the tree-sitter ingestion.
+    """
+    start = time.perf_counter()
+    try:
+        tu = index.parse(file_path, args=args, options=PARSE_OPTIONS)
+    except TranslationUnitLoadError as e:
+        print(f"Cannot parse {file_path} with clang ({e}), using the regex chunker")
+        with open(file_path, 'rb') as f:
+            code = f.read()
+        skip_files.add(file_path)
+        docs = extract_header_chunks(code.decode('utf-8', errors='replace'), file_path)
+        return [(file_path, hashlib.sha256(code).hexdigest(), 'utf-8', docs)]
+    now = time.perf_counter()
+    timings['parse'] += now - start
+    start = now
+
+    # Top level cursors of each file, in the order of the translation unit
+    files = {}
+    skipped = set()
+    for cursor in tu.cursor.get_children():
+        if cursor.location.is_in_system_header:
+            continue
+        cursor_path = cursor_file(cursor, directory)
+        if cursor_path is None or cursor_path in skipped:
+            continue
+        if cursor_path not in files and cursor_path in skip_files:
+            # Looked up once per file, a lookup in SharedFiles is a call to the manager process
+            skipped.add(cursor_path)
+            continue
+        includes, cursors = files.setdefault(cursor_path, ([], []))
+        if cursor.kind == CursorKind.INCLUSION_DIRECTIVE:
+            includes.append(cursor.spelling)
+        elif cursor.kind not in (CursorKind.MACRO_DEFINITION, CursorKind.MACRO_INSTANTIATION):
+            cursors.append(cursor)
+    timings['chunk'] += time.perf_counter() - start
+
+    results = []
+    for cursor_path, (includes, cursors) in files.items():
+        start = time.perf_counter()
+        with open(cursor_path, 'rb') as f:
+            code = f.read()
+        content_hash = hashlib.sha256(code).hexdigest()
+        now = time.perf_counter()
+        timings['read'] += now - start
+        docs = chunk_cursors(cursors, code, cursor_path, includes, ast_dump, directory)
+        timings['chunk'] += time.perf_counter() - now
+        results.append((cursor_path, content_hash, 'utf-8', docs))
+        skip_files.add(cursor_path)
+    return results
+
+
+class SharedFiles:
+    """
+    Files chunked by the workers of iter_clang_results, claims shared through a manager dict
+    (path -> worker pid). A file not chunked yet is claimed by the first worker looking it up,
+    the other workers then skip it.
+    """
+
+    def __init__(self, claims):
+        self.claims = claims
+        self.chunked = set()
+
+    def __contains__(self, file_path: str) -> bool:
+        if file_path in self.chunked:
+            return True
+        return self.claims.setdefault(file_path, os.getpid()) != os.getpid()
+
+    def add(self, file_path: str):
+        self.chunked.add(file_path)
+        self.claims.setdefault(file_path, os.getpid())
+
+
+# One libclang index per worker process, and the files chunked by the workers
+_worker_index = None
+_worker_seen = None
+
+
+def _init_clang_worker(claims):
+    global _worker_index, _worker_seen
+    _worker_index = Index.create()
+    _worker_seen = SharedFiles(claims)
+
+
+def _parse_command(command: tuple, ast_dump: bool):
+    timings = new_timings()
+    file_path, args, directory = command
+    return parse_translation_unit(_worker_index, file_path, args, directory, _worker_seen, timings, ast_dump), timings
+
+
+def iter_clang_results(compile_commands_path: str, workers: int = 1, max_pending: int = None,
+                       ast_dump: bool = None):
+    """
+    Yield (results, timings) batches, one per translation unit of a compile_commands.json,
+    translation units are parsed by `workers` processes. Every file (header) is chunked and yielded once:
+    workers skip the files claimed by any worker (SharedFiles).
+    """
+    commands = load_compile_commands(compile_commands_path)
+    emitted = set()
+
+    def new_files(results):
+        results = [result for result in results if result[0] not in emitted]
+        emitted.update(result[0] for result in results)
+        return results
+
+    if workers <= 1:
+        index = Index.create()
+        for file_path, args, directory in commands:
+            timings = new_timings()
+            results = parse_translation_unit(index, file_path, args, directory, emitted, timings, ast_dump)
+            yield results, timings
+        return
+
+    max_pending = max_pending or 2 * workers
+    # Spawned for the same reason as the workers of iter_cpp_results
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, \
+            context.Pool(processes=workers, initializer=_init_clang_worker, initargs=(manager.dict(),)) as pool:
+        pending = deque()
+        for command in commands:
+            pending.append(pool.apply_async(_parse_command, (command, ast_dump)))
+            if len(pending) >= max_pending:
+                results, timings = pending.popleft().get()
+                yield new_files(results), timings
+        while pending:
+            results, timings = pending.popleft().get()
+            yield new_files(results), timings
+
+
+def iter_clang_documents(compile_commands_path: str, workers: int = 1):
+    """
+    Yield (documents, timings) batches, one per translation unit.
+    """
+    for results, timings in iter_clang_results(compile_commands_path, workers):
+        yield [doc for _, _, _, docs in results for doc in docs], timings
+
+
+# Regex fallback chunker, for files clang cannot parse.
+# Function signatures are matched from their name backwards on a bounded window, so a long
+# template heavy line can't make the patterns backtrack over the whole file.
+MAX_SIGNATURE = 512
+MAX_PARAMETERS = 4096
+BRACE_TOKEN_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|[{}]', re.DOTALL)
+INCLUDE_RE = re.compile(r'#include\s*["<](\w+\.\w+)[">]')
+CLASS_RE = re.compile(r'(?:template\s*<[^<>{};]*(?:<[^<>{};]*>[^<>{};]*)*>\s*)?(?<!enum\s)\b(?:class|struct)\s+(\w+)[^{};()]*\{')
+ENUM_RE = re.compile(r'\benum(?:\s+(?:class|struct))?\s+\w+[^;{}()]*\{')
+TYPEDEF_RE = re.compile(r'\btypedef\s[^;{}]*;|\busing\s+\w+\s*=\s*[^;{}]+;')
+FUNCTION_NAME_RE = re.compile(r'(?<![\w~])(~?[A-Za-z_]\w*(?:::~?[A-Za-z_]\w*)*)\s*\(')
+CALL_RE = re.compile(r'\b(?:\w+::)?(\w+)\s*\(')
+PREFIX_NOISE_RE = re.compile(r'//[^\n]*|/\*.*?\*/|^[ \t]*#[^\n]*|\b(?:public|private|protected)\s*:(?!:)',
+                             re.DOTALL | re.MULTILINE)
+RETURN_TYPE_RE = re.compile(r'\s*(?:template\s*<[^;{}]*>\s*)?(?:[\w:<>,]+[\s*&]+)+')
+PARAMETERS_RE = re.compile(r'[^;{}()]*(?:\([^;{}()]*\)[^;{}()]*)*\)')
+QUALIFIERS_RE = re.compile(r'\s*(?:(?:const|volatile|noexcept|override|final)\b\s*)*(?:=\s*(?:0|default|delete)\s*)?([;{])')
+NOT_FUNCTIONS = frozenset(('if', 'for', 'while', 'switch', 'catch', 'return', 'sizeof', 'alignof', 'decltype',
+                           'static_assert', 'defined'))
+NOT_TYPES = frozenset(('return', 'else', 'new', 'delete', 'throw', 'case', 'goto', 'do', 'typedef', 'using'))
+
+Position = namedtuple('Position', 'offset line column')
+Extent = namedtuple('Extent', 'start end')
+
+
+def match_braces(code: str) -> dict:
+    """
+    Offset of the closing brace of each opening brace of code, in one pass.
+    Braces in comments, strings and characters are ignored, unbalanced braces are left out.
+    """
+    closes = {}
+    stack = []
+    for match in BRACE_TOKEN_RE.finditer(code):
+        token = match.group()
+        if token == '{':
+            stack.append(match.start())
+        elif token == '}' and stack:
+            closes[stack.pop()] = match.start()
+    return closes
+
+
+def merge_intervals(intervals) -> tuple:
+    """
+    Sorted starts and ends of the union of [start, end) intervals.
+    """
+    starts, ends = [], []
+    for start, end in sorted(intervals):
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def in_intervals(merged: tuple, start: int, end: int) -> bool:
+    """
+    Whether [start, end) is inside one of the merged intervals.
+    """
+    starts, ends = merged
+    i = bisect_right(starts, start) - 1
+    return i >= 0 and end <= ends[i]
+
+
+def find_classes(code: str, closes: dict) -> list:
+    """
+    Returns [(start, end, name), ...] of the class and struct definitions of code, nested ones included.
+    """
+    classes = []
+    for match in CLASS_RE.finditer(code):
+        close = closes.get(match.end() - 1)
+        if close is not None:
+            classes.append((match.start(), close + 1, match.group(1)))
+    return classes
+
+
+def find_blocks(pattern, code: str, closes: dict) -> list:
+    """
+    Returns [(start, end), ...] of the `{...};` blocks opened by the matches of pattern (enums).
+    """
+    blocks = []
     for match in pattern.finditer(code):
-        class_name = match.group(2)
-        start = match.start()
-        brace_pos = code.find('{', match.end() - 1)
-        if brace_pos == -1:
+        close = closes.get(match.end() - 1)
+        if close is not None and code.startswith(';', close + 1):
+            blocks.append((match.start(), close + 2))
+    return blocks
+
+
+def find_functions(code: str, start: int, end: int, closes: dict, skip: tuple = ([], [])) -> list:
+    """
+    Returns [(start, end, name), ...] of the function declarations and definitions between start and end,
+    outside of the merged skip intervals. Bodies are not searched for nested matches.
+    """
+    functions = []
+    position = start
+    for skip_start, skip_end in zip(*skip):
+        if skip_end <= position:
+            continue
+        if skip_start >= end:
+            break
+        if skip_start > position:
+            functions.extend(find_segment_functions(code, position, skip_start, closes))
+        position = skip_end
+    if position < end:
+        functions.extend(find_segment_functions(code, position, end, closes))
+    return functions
+
+
+def find_segment_functions(code: str, start: int, end: int, closes: dict) -> list:
+    functions = []
+    position = start
+    while True:
+        match = FUNCTION_NAME_RE.search(code, position, end)
+        if match is None:
+            return functions
+        position = match.end()
+        name_start = match.start()
+        if match.group(1) in NOT_FUNCTIONS:
+            continue
+
+        # Start of the statement, within MAX_SIGNATURE characters
+        window = max(start, name_start - MAX_SIGNATURE)
+        boundary = max(code.rfind(';', window, name_start), code.rfind('{', window, name_start),
+                       code.rfind('}', window, name_start))
+        if boundary < 0 and window > start:
+            continue
+        statement = max(boundary + 1, start)
+        for noise in PREFIX_NOISE_RE.finditer(code, statement, name_start):
+            statement = noise.end()
+        if RETURN_TYPE_RE.fullmatch(code, statement, name_start) is None:
+            continue
+        prefix = code[statement:name_start]
+        if prefix.split(None, 1)[0] in NOT_TYPES:
             continue
 
-        depth = 1
-        pos = brace_pos + 1
-        while pos < len(code) and depth > 0:
-            if code[pos] == '{':
-                depth += 1
-            elif code[pos] == '}':
-                depth -= 1
-            pos += 1
+        parameters = PARAMETERS_RE.match(code, match.end(), min(end, match.end() + MAX_PARAMETERS))
+        if parameters is None:
+            continue
+        qualifiers = QUALIFIERS_RE.match(code, parameters.end(), end)
+        if qualifiers is None:
+            continue
+        if qualifiers.group(1) == '{':
+            close = closes.get(qualifiers.end() - 1)
+            if close is None:
+                continue
+            function_end = close + 1
+        else:
+            function_end = qualifiers.end()
+        functions.append((statement + len(prefix) - len(prefix.lstrip()), function_end, match.group(1)))
+        # The body is not searched
+        position = function_end
+
+
+def used_functions(code: str, start: int, end: int, defined: list) -> list:
+    """
+    Names called between start and end, except keywords and the defined functions.
+    """
+    defined = {name.rsplit('::', 1)[-1].lstrip('~') for name in defined}
+    return list(set(CALL_RE.findall(code, start, end)) - defined - NOT_FUNCTIONS)
 
-        end = pos
-        class_code = code[start:end]
-        matches.append((class_name, class_code))
 
-    return matches
+def extract_defined_and_used_functions_regex(code: str):
+    defined = [name for _, _, name in find_functions(code, 0, len(code), match_braces(code))]
+    return defined, used_functions(code, 0, len(code), defined)
+
+
+def extract_class_blocks_with_brace_matching(code: str):
+    return [(name, code[start:end]) for start, end, name in find_classes(code, match_braces(code))]
 
 
 def extract_header_chunks(code: str, file_path: str):
+    """
+    Chunks of the classes (with their enums, typedefs and functions), global enums, typedefs and free
+    functions of a header, matched with regexes. Braces are matched once for the whole file and global
+    matches inside an already chunked block are skipped by offset, so the work is linear in the file size.
+    """
     chunks = []
-    includes = re.findall(r'#include\s*["<](\w+\.\w+)[">]', code)
-
-    # Traitement des classes / structs
-    class_blocks = extract_class_blocks_with_brace_matching(code)
-    for class_name, class_code in class_blocks:
-        # Chunk pour la classe elle-même
-        defined, used = extract_defined_and_used_functions_regex(class_code)
-        chunks.extend(create_chunk(class_code, file_path, "class", includes=includes,
-                                   defined=defined, used=used, generator="regex"))
-
-        # Enums dans la classe
-        enum_matches = re.finditer(r'(?:enum(?:\s+class)?\s+\w+\s*[^}]*\{[^}]*\};)', class_code, re.DOTALL)
-        for match in enum_matches:
-            enum_code = match.group(0)
-            chunks.extend(create_chunk(enum_code, file_path, "enum", includes=includes,
-                                       defined=[], used=[], parent_class=class_name, generator="regex"))
-
-        # Typedef / using dans la classe
-        typedef_matches = re.finditer(r'\b(?:typedef\s+.+?;|using\s+\w+\s*=\s*[^;]+;)', class_code)
-        for match in typedef_matches:
-            typedef_code = match.group(0)
-            chunks.extend(create_chunk(typedef_code, file_path, "typedef", includes=includes,
-                                       defined=[], used=[], parent_class=class_name, generator="regex"))
-
-        # Fonctions internes à la classe
-        function_matches = re.finditer(
-            r'(?:inline\s+)?(?:explicit\s+)?(?:[\w:<>]+[\s*&]+)+(\w+)\s*\([^;{]*\)\s*(?:const)?\s*(?:noexcept)?\s*(?:=\s*0)?\s*(?:override)?\s*(?:final)?\s*(?:;|{[^}]*})',
-            class_code)
-        for match in function_matches:
-            func_code = match.group(0)
-            defined, used = extract_defined_and_used_functions_regex(func_code)
-            chunks.extend(create_chunk(func_code, file_path, "function", includes=includes,
-                                       defined=defined, used=used, parent_class=class_name, generator="regex"))
-
-    # Enums globaux (hors classe)
-    enum_matches = re.finditer(r'(?:enum(?:\s+class)?\s+\w+\s*[^}]*\{[^}]*\};)', code, re.DOTALL)
-    for match in enum_matches:
-        enum_code = match.group(0)
-        # On évite les doublons d’enum déjà vus dans des classes
-        if not any(enum_code in c["content"] for c in chunks):
-            chunks.extend(create_chunk(enum_code, file_path, "enum", includes=includes,
-                                       defined=[], used=[], generator="regex"))
-
-    # Typedef / using globaux
-    typedef_matches = re.finditer(r'\b(?:typedef\s+.+?;|using\s+\w+\s*=\s*[^;]+;)', code)
-    for match in typedef_matches:
-        typedef_code = match.group(0)
-        if not any(typedef_code in c["content"] for c in chunks):
-            chunks.extend(create_chunk(typedef_code, file_path, "typedef", includes=includes,
-                                       defined=[], used=[], generator="regex"))
-
-    # Fonctions libres (hors classes)
-    function_matches = re.finditer(
-        r'(?:inline\s+)?(?:explicit\s+)?(?:[\w:<>]+[\s*&]+)+(\w+)\s*\([^;{]*\)\s*(?:const)?\s*(?:noexcept)?\s*(?:=\s*0)?\s*(?:override)?\s*(?:final)?\s*(?:;|{[^}]*})',
-        code)
-    for match in function_matches:
-        func_code = match.group(0)
-        if not any(func_code in c["content"] for c in chunks):
-            defined, used = extract_defined_and_used_functions_regex(func_code)
-            chunks.extend(create_chunk(func_code, file_path, "function", includes=includes,
-                                       defined=defined, used=used, generator="regex"))
-
-    print(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
+    includes = INCLUDE_RE.findall(code)
+    closes = match_braces(code)
+    line_starts = [0] + [match.end() for match in re.finditer('\n', code)]
+
+    def extent(start, end):
+        # Lines and columns from 1 like clang extents
+        start_line = bisect_right(line_starts, start)
+        end_line = bisect_right(line_starts, end)
+        return Extent(Position(start, start_line, start - line_starts[start_line - 1] + 1),
+                      Position(end, end_line, end - line_starts[end_line - 1] + 1))
+
+    def add_chunk(start, end, chunk_type, defined=None, current_class=None):
+        used = used_functions(code, start, end, defined or []) if chunk_type in ("class", "struct", "function") else []
+        chunks.extend(create_chunk(code, file_path, chunk_type, extent=extent(start, end), includes=includes,
+                                   current_class=current_class, defined=defined or [], used=used,
+                                   generator="regex"))
+
+    # Classes / structs, with their enums, typedefs and functions
+    classes = find_classes(code, closes)
+    all_enums = find_blocks(ENUM_RE, code, closes)
+    enum_starts = [start for start, _ in all_enums]
+    for class_start, class_end, class_name in classes:
+        body_start = code.index('{', class_start) + 1
+        functions = find_functions(code, body_start, class_end - 1, closes)
+        is_struct = re.search(rf'\bstruct\s+{class_name}\b', code[class_start:body_start]) is not None
+        add_chunk(class_start, class_end, "struct" if is_struct else "class",
+                  defined=[name for _, _, name in functions], current_class=class_name)
+        for start, end in all_enums[bisect_left(enum_starts, body_start):bisect_left(enum_starts, class_end)]:
+            add_chunk(start, end, "enum", current_class=class_name)
+        for match in TYPEDEF_RE.finditer(code, body_start, class_end):
+            add_chunk(match.start(), match.end(), "typedef", current_class=class_name)
+        for start, end, name in functions:
+            add_chunk(start, end, "function", defined=[name], current_class=class_name)
+
+    # Global enums, typedefs and free functions, outside of the chunked blocks
+    covered = merge_intervals((start, end) for start, end, _ in classes)
+    functions = find_functions(code, 0, len(code), closes, skip=covered)
+    enums = [block for block in all_enums if not in_intervals(covered, *block)]
+    covered = merge_intervals([(start, end) for start, end, _ in classes + functions] + enums)
+    for start, end in enums:
+        add_chunk(start, end, "enum")
+    for match in TYPEDEF_RE.finditer(code):
+        if not in_intervals(covered, match.start(), match.end()):
+            add_chunk(match.start(), match.end(), "typedef")
+    for start, end, name in functions:
+        add_chunk(start, end, "function", defined=[name])
+
+    logger.debug(f"Chunks generated for {file_path}, chunks: {len(chunks)}")
     return chunks
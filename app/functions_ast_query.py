@@ -0,0 +1,113 @@
+from functions_ast import (
+    extract_chunks as extract_chunks_visitor,
+    extract_defined_functions,
+    include_name,
+    new_spec,
+    node_line_count,
+    node_text,
+    unique_used,
+)
+from functions_parsing import get_language
+
+# Nodes needed to build chunks, matched by tree-sitter in C instead of walking every node in Python
+CHUNK_QUERY = get_language().query("""
+(preproc_include) @include
+(namespace_definition) @namespace
+(class_specifier) @class
+(struct_specifier) @class
+(function_definition) @function
+(enum_specifier) @enum
+(type_definition) @enum
+(call_expression function: (_) @call)
+""")
+
+
+def query_tree(root_node, code_bytes: bytes):
+    """
+    Same result as functions_ast.visit_tree, from the captures of CHUNK_QUERY.
+    Captures are swept in source order, the enclosing namespaces, classes and chunk candidates
+    of a capture being the open ones whose byte range contains it.
+    """
+
+    includes = []
+    namespace_stack = []
+    class_stack = []
+    specs = []
+    open_specs = []
+    # (end_byte, kind) of the enclosing nodes, innermost last
+    containers = []
+
+    def close(kind):
+        if kind == 'namespace':
+            namespace_stack.pop()
+        elif kind == 'class':
+            class_stack.pop()
+        else:
+            spec = open_specs.pop()
+            spec["used"] = unique_used(spec["used"], spec["defined"])
+
+    captures = sorted(CHUNK_QUERY.captures(root_node), key=lambda c: (c[0].start_byte, -c[0].end_byte))
+    for node, capture in captures:
+        while containers and containers[-1][0] <= node.start_byte:
+            close(containers.pop()[1])
+
+        if capture == 'call':
+            fn_name = node_text(node, code_bytes)
+            for spec in open_specs:
+                spec["used"].append(fn_name)
+
+        elif capture == 'include':
+            includes.append(include_name(node, code_bytes))
+
+        elif capture == 'namespace':
+            ns_name = next(
+                (node_text(c, code_bytes) for c in node.children if c.type == 'namespace_identifier'),
+                None
+            )
+            namespace_stack.append(ns_name)
+            containers.append((node.end_byte, 'namespace'))
+
+        elif capture == 'class':
+            class_name = next(
+                (node_text(c, code_bytes) for c in node.children if c.type == 'type_identifier'),
+                None
+            )
+            class_stack.append(class_name)
+            containers.append((node.end_byte, 'class'))
+            if node_line_count(node) >= 5:
+                spec = new_spec(node, node.type, class_name, namespace_stack)
+                specs.append(spec)
+                open_specs.append(spec)
+                containers.append((node.end_byte, 'spec'))
+
+        elif capture == 'function':
+            defined = extract_defined_functions(node, code_bytes)
+            for spec in open_specs:
+                if spec["type"] in ('class_specifier', 'struct_specifier'):
+                    spec["defined"].extend(defined)
+            current_class = class_stack[-1] if class_stack else None
+            if current_class is None and node_line_count(node) >= 3:
+                spec = new_spec(node, node.type, None, namespace_stack, defined)
+                specs.append(spec)
+                open_specs.append(spec)
+                containers.append((node.end_byte, 'spec'))
+
+        elif capture == 'enum':
+            if node_line_count(node) >= 3:
+                current_class = class_stack[-1] if class_stack else None
+                spec = new_spec(node, node.type, current_class, namespace_stack)
+                specs.append(spec)
+                open_specs.append(spec)
+                containers.append((node.end_byte, 'spec'))
+
+    while containers:
+        close(containers.pop()[1])
+
+    return includes, specs
+
+
+def extract_chunks(root_node, code, file_path: str):
+    """
+    Query-driven version of functions_ast.extract_chunks.
+    """
+    return extract_chunks_visitor(root_node, code, file_path, collect=query_tree)
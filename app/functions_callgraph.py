@@ -0,0 +1,217 @@
+import numpy as np
+import re
+
+from functions_chunkstore import load_versioned, save_versioned
+
+CALLGRAPH_PREFIX = "callgraph"
+# Last identifier of a call target: ns::f, obj.f, ptr->f, f<T>
+CALLEE_NAME_RE = re.compile(r'([A-Za-z_~][A-Za-z0-9_]*)\s*(?:<[^<>]*>)?\s*$')
+# Calls to a name defined in more chunks than this (size, get...) are not resolved
+MAX_TARGETS = 32
+# Frontiers up to this size are expanded row by row
+SMALL_FRONTIER = 64
+# Chunks with more calls than this (in and out: logging, accessors) are reached but not expanded
+MAX_FANOUT = 64
+# Chunks added per hop of an expansion, by fewest calls first
+MAX_HOP_CANDIDATES = 64
+
+
+def callee_name(used_function: str):
+    """
+    Name a call resolves to: `gw::checkLoaderConfigurationFile` -> checkLoaderConfigurationFile.
+    """
+    match = CALLEE_NAME_RE.search(used_function)
+    return match.group(1) if match else None
+
+
+def csr_from_edges(nb_nodes: int, sources, targets):
+    """
+    Returns (offsets, targets) arrays: targets of node i are targets[offsets[i]:offsets[i + 1]], sorted.
+    """
+    sources = np.asarray(sources, dtype='int64')
+    targets = np.asarray(targets, dtype='int32')
+    order = np.lexsort((targets, sources))
+    offsets = np.zeros(nb_nodes + 1, dtype='int64')
+    np.cumsum(np.bincount(sources, minlength=nb_nodes), out=offsets[1:])
+    return offsets, targets[order]
+
+
+def csr_neighbors(offsets, targets, rows):
+    """
+    Concatenated neighbors of rows, without a Python loop over them.
+    """
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=targets.dtype)
+    # Index of each neighbor: start of its row + position in the row
+    positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return targets[np.repeat(starts, lengths) + positions]
+
+
+class CallGraph:
+    """
+    Call graph between chunks: a chunk calls the chunks defining the functions it uses.
+    Calls are resolved to definitions of the same file first, then of any file.
+    Nodes are chunk rows (chunk_ids[row]), callees and callers are stored as CSR arrays,
+    defining rows of each interned symbol too. Saved as .npy files, memory mapped on load.
+    """
+
+    ARRAYS = ("chunk_ids", "out_offsets", "out_targets", "in_offsets", "in_sources", "def_offsets", "def_rows")
+
+    def __init__(self, symbols: list, chunk_ids, out_offsets, out_targets, in_offsets, in_sources,
+                 def_offsets, def_rows):
+        self.symbols = symbols
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+        self.chunk_ids = chunk_ids
+        self.out_offsets = out_offsets
+        self.out_targets = out_targets
+        self.in_offsets = in_offsets
+        self.in_sources = in_sources
+        self.def_offsets = def_offsets
+        self.def_rows = def_rows
+
+    @classmethod
+    def from_edges(cls, chunk_ids, sources, targets, symbols: list = None, def_offsets=None, def_rows=None):
+        """
+        Build graph from edge arrays between chunk rows.
+        """
+        nb_nodes = len(chunk_ids)
+        out_offsets, out_targets = csr_from_edges(nb_nodes, sources, targets)
+        in_offsets, in_sources = csr_from_edges(nb_nodes, targets, sources)
+        if def_offsets is None:
+            def_offsets, def_rows = np.zeros(1, dtype='int64'), np.zeros(0, dtype='int32')
+        return cls(symbols or [], np.asarray(chunk_ids, dtype='int64'), out_offsets, out_targets,
+                   in_offsets, in_sources, def_offsets, def_rows)
+
+    @classmethod
+    def build(cls, chunks_metadata):
+        """
+        Build graph from (chunk id, metadata) pairs of the chunk store.
+        """
+        chunk_ids = []
+        files = []
+        used = []
+        symbol_ids = {}
+        definitions = []
+        for row, (chunk_id, metadata) in enumerate(chunks_metadata):
+            chunk_ids.append(chunk_id)
+            files.append(metadata['file_path'])
+            for func in set(metadata.get('defined_functions', [])):
+                definitions.append((symbol_ids.setdefault(callee_name(func) or func, len(symbol_ids)), row))
+            used.append({callee_name(func) for func in metadata.get('used_functions', [])} - {None})
+
+        symbols = sorted(symbol_ids, key=symbol_ids.get)
+        def_offsets, def_rows = csr_from_edges(len(symbols), [s for s, _ in definitions],
+                                               [r for _, r in definitions])
+        sources, targets = [], []
+        for row, names in enumerate(used):
+            for name in sorted(names):
+                symbol_id = symbol_ids.get(name)
+                if symbol_id is None:
+                    continue
+                rows = def_rows[def_offsets[symbol_id]:def_offsets[symbol_id + 1]].tolist()
+                same_file = [r for r in rows if files[r] == files[row]]
+                rows = same_file or rows
+                if len(rows) > MAX_TARGETS:
+                    continue
+                for target in set(rows) - {row}:
+                    sources.append(row)
+                    targets.append(target)
+        return cls.from_edges(chunk_ids, sources, targets, symbols, def_offsets, def_rows)
+
+    def save(self, index_path: str):
+        """
+        Save graph next to the FAISS files (see save_versioned).
+        """
+        save_versioned(index_path, CALLGRAPH_PREFIX, {name: getattr(self, name) for name in self.ARRAYS},
+                       "symbols", self.symbols)
+
+    @classmethod
+    def load(cls, index_path: str):
+        """
+        Load graph saved next to the FAISS files (arrays are memory mapped), returns None if there is none.
+        """
+        saved = load_versioned(index_path, CALLGRAPH_PREFIX, cls.ARRAYS, "symbols")
+        if saved is None:
+            return None
+        symbols, arrays = saved
+        # Plain views of the maps, indexing np.memmap objects has a per call overhead
+        return cls(symbols, **{name: np.asarray(array) for name, array in arrays.items()})
+
+    def rows(self, chunk_ids) -> np.ndarray:
+        """
+        Rows of the given chunk ids (chunk_ids is sorted), unknown ids are dropped.
+        """
+        chunk_ids = np.asarray(chunk_ids, dtype='int64')
+        if not len(self.chunk_ids):
+            return np.zeros(0, dtype='int64')
+        rows = np.minimum(np.searchsorted(self.chunk_ids, chunk_ids), len(self.chunk_ids) - 1)
+        return rows[self.chunk_ids[rows] == chunk_ids]
+
+    def definitions(self, name: str) -> list:
+        """
+        Ids of the chunks defining a function.
+        """
+        symbol_id = self.symbol_ids.get(callee_name(name) or name)
+        if symbol_id is None:
+            return []
+        return self.chunk_ids[self.def_rows[self.def_offsets[symbol_id]:self.def_offsets[symbol_id + 1]]].tolist()
+
+    def _neighbors(self, rows: list, callees: bool, callers: bool) -> list:
+        csr = []
+        if callees:
+            csr.append((self.out_offsets, self.out_targets))
+        if callers:
+            csr.append((self.in_offsets, self.in_sources))
+        neighbors = []
+        for offsets, targets in csr:
+            if len(rows) <= SMALL_FRONTIER:
+                # Slicing per row is cheaper than the vectorized version on a few rows
+                for row in rows:
+                    neighbors.extend(targets[offsets[row]:offsets[row + 1]].tolist())
+            else:
+                neighbors.extend(np.unique(csr_neighbors(offsets, targets, np.array(rows))).tolist())
+        return neighbors
+
+    def _degrees(self, rows, callees: bool, callers: bool) -> np.ndarray:
+        degrees = np.zeros(len(rows), dtype='int64')
+        if callees:
+            degrees += self.out_offsets[rows + 1] - self.out_offsets[rows]
+        if callers:
+            degrees += self.in_offsets[rows + 1] - self.in_offsets[rows]
+        return degrees
+
+    def expand(self, chunk_ids, hops: int = 2, callees: bool = True, callers: bool = True,
+               max_fanout: int = MAX_FANOUT, max_per_hop: int = MAX_HOP_CANDIDATES) -> dict:
+        """
+        Chunks reachable in at most `hops` calls from chunk_ids (callees, callers or both),
+        returns chunk id -> number of hops (chunk_ids themselves are not included).
+        Reached chunks with more than max_fanout calls are not expanded, at most max_per_hop chunks
+        are added per hop, those with the fewest calls first (None for no bound).
+        """
+        # Explored rows only, a mask of all rows would cost O(nodes) per query
+        visited = set(self.rows(chunk_ids).tolist())
+        frontier = list(visited)
+        distances = {}
+        for hop in range(1, hops + 1):
+            frontier = list(set(self._neighbors(frontier, callees, callers)) - visited)
+            if not frontier:
+                break
+            rows = np.array(frontier)
+            degrees = None
+            if max_per_hop is not None and len(rows) > max_per_hop:
+                # Sorted first: ties by row, the same candidates for the same query
+                rows.sort()
+                degrees = self._degrees(rows, callees, callers)
+                order = np.argsort(degrees, kind='stable')[:max_per_hop]
+                rows, degrees = rows[order], degrees[order]
+                frontier = rows.tolist()
+            visited.update(frontier)
+            distances.update(dict.fromkeys(self.chunk_ids[rows].tolist(), hop))
+            if max_fanout is not None and hop < hops:
+                if degrees is None:
+                    degrees = self._degrees(rows, callees, callers)
+                frontier = rows[degrees <= max_fanout].tolist()
+        return distances
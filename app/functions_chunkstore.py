@@ -0,0 +1,251 @@
+import faiss
+import json
+from langchain_core.documents import Document
+import numpy as np
+import os
+import re
+import sqlite3
+import threading
+
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.sqlite"
+
+
+def replace_file(file_path: str, write, mode: str = 'wb'):
+    """
+    Write a file through write(f) to a temporary file, then replace it atomically:
+    readers never see a partial file and memory maps of the previous one stay valid.
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, file_path)
+
+
+def save_versioned(index_path: str, prefix: str, arrays: dict, key: str, content):
+    """
+    Save the arrays of an index as <prefix>_<name>.<version>.npy under a new version, then
+    <prefix>_<key>.json = {"version": ..., key: content}. The json is replaced last: readers load the
+    arrays of the version it names, never a mix of two saves. Files of previous versions are removed,
+    memory maps of them stay valid.
+    """
+    versions = [int(name.split('.')[-2]) for name in os.listdir(index_path)
+                if name.startswith(f"{prefix}_") and re.fullmatch(r'[^.]+\.\d+\.npy', name)]
+    version = max(versions, default=0) + 1
+    for name, array in arrays.items():
+        replace_file(os.path.join(index_path, f"{prefix}_{name}.{version}.npy"), lambda f: np.save(f, array))
+    replace_file(os.path.join(index_path, f"{prefix}_{key}.json"),
+                 lambda f: json.dump({"version": version, key: content}, f), 'w')
+    for name in os.listdir(index_path):
+        if name.startswith(f"{prefix}_") and name.endswith(".npy") and not name.endswith(f".{version}.npy"):
+            os.remove(os.path.join(index_path, name))
+
+
+def load_versioned(index_path: str, prefix: str, names: tuple, key: str):
+    """
+    Returns (content, memory mapped arrays) saved by save_versioned, or None if there is none.
+    """
+    json_file = os.path.join(index_path, f"{prefix}_{key}.json")
+    if not os.path.exists(json_file):
+        return None
+    with open(json_file, 'r') as f:
+        saved = json.load(f)
+    # Saves from before versions: {key} content only, arrays without version
+    suffix, content = (f".{saved['version']}", saved[key]) if isinstance(saved, dict) else ("", saved)
+    return content, {name: np.load(os.path.join(index_path, f"{prefix}_{name}{suffix}.npy"), mmap_mode='r')
+                     for name in names}
+
+
+class ChunkStore:
+    """
+    Chunks stored in SQLite, keyed by FAISS id.
+    Text and metadata are only read for the requested ids, nothing is unpickled.
+    """
+
+    def __init__(self, db_path: str, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+        # SQLite connections can't be shared between threads
+        self._local = threading.local()
+        if not read_only:
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "id INTEGER PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.read_only:
+                connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            else:
+                connection = sqlite3.connect(self.db_path)
+            self._local.connection = connection
+        return connection
+
+    def add(self, chunk_id: int, doc: Document):
+        self.add_many([chunk_id], [doc])
+
+    def add_many(self, ids, docs: list):
+        """
+        Insert chunks with their ids in a single statement.
+        """
+        self._connection().executemany(
+            "INSERT OR REPLACE INTO chunks (id, page_content, metadata) VALUES (?, ?, ?)",
+            ((int(chunk_id), doc.page_content, json.dumps(doc.metadata)) for chunk_id, doc in zip(ids, docs))
+        )
+
+    def delete(self, ids: list):
+        self._connection().executemany("DELETE FROM chunks WHERE id = ?", [(int(i),) for i in ids])
+
+    def get(self, ids: list) -> list:
+        """
+        Returns chunks of the given ids, in the same order (unknown ids are skipped).
+        """
+        ids = [int(i) for i in ids]
+        docs = self.get_by_id(ids)
+        return [docs[i] for i in ids if i in docs]
+
+    def get_by_id(self, ids: list) -> dict:
+        """
+        Returns id -> chunk for the given ids found in the store.
+        """
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        rows = self._connection().execute(
+            f"SELECT id, page_content, metadata FROM chunks WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        return {row[0]: Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows}
+
+    def get_all(self) -> list:
+        rows = self._connection().execute("SELECT page_content, metadata FROM chunks ORDER BY id")
+        return [Document(page_content=row[0], metadata=json.loads(row[1])) for row in rows]
+
+    def _iter_column(self, column: str, ids=None, batch_size: int = 500):
+        if ids is None:
+            yield from self._connection().execute(f"SELECT id, {column} FROM chunks ORDER BY id")
+            return
+        # Batched under the SQLite limit of query parameters
+        ids = sorted(int(i) for i in ids)
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            yield from self._connection().execute(
+                f"SELECT id, {column} FROM chunks WHERE id IN ({','.join('?' * len(batch))}) ORDER BY id", batch
+            )
+
+    def iter_metadata(self, ids=None):
+        """
+        Yield (id, metadata) of all chunks (or of the given ids), without their text.
+        """
+        for chunk_id, metadata in self._iter_column("metadata", ids):
+            yield chunk_id, json.loads(metadata)
+
+    def iter_content(self, ids=None):
+        """
+        Yield (id, text) of all chunks (or of the given ids).
+        """
+        yield from self._iter_column("page_content", ids)
+
+    def ids(self) -> np.ndarray:
+        """
+        Sorted ids of all chunks.
+        """
+        return np.array([row[0] for row in self._connection().execute("SELECT id FROM chunks ORDER BY id")],
+                        dtype='int64')
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def commit(self):
+        self._connection().commit()
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def takes_ids(index) -> bool:
+    """
+    Whether vectors are added with chunk ids: ID map wrapper, or IVF index (ids stored in its lists).
+    """
+    return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexIVF))
+
+
+class VectorStore:
+    """
+    FAISS index and the chunks of its vectors, saved together in index_path.
+    """
+
+    def __init__(self, index_path: str, index, chunks: ChunkStore):
+        self.index_path = index_path
+        self.index = index
+        self.chunks = chunks
+
+    @staticmethod
+    def exists(index_path: str) -> bool:
+        return os.path.exists(os.path.join(index_path, INDEX_FILE)) \
+            and os.path.exists(os.path.join(index_path, CHUNKS_FILE))
+
+    @classmethod
+    def create(cls, index_path: str, index):
+        os.makedirs(index_path, exist_ok=True)
+        return cls(index_path, index, ChunkStore(os.path.join(index_path, CHUNKS_FILE)))
+
+    @classmethod
+    def load(cls, index_path: str, read_only: bool = False):
+        index = faiss.read_index(os.path.join(index_path, INDEX_FILE))
+        return cls(index_path, index, ChunkStore(os.path.join(index_path, CHUNKS_FILE), read_only=read_only))
+
+    def add(self, vectors, docs: list, ids=None, chunk_size: int = 4096):
+        """
+        Bulk insert vectors and their chunks, returns the ids of the chunks.
+        Without ids (index without ids), the chunks get the contiguous FAISS rows of their vectors.
+        """
+        if ids is None:
+            ids = np.arange(self.index.ntotal, self.index.ntotal + len(docs), dtype='int64')
+        else:
+            ids = np.asarray(ids, dtype='int64')
+        for start in range(0, len(vectors), chunk_size):
+            if takes_ids(self.index):
+                self.index.add_with_ids(vectors[start:start + chunk_size], ids[start:start + chunk_size])
+            else:
+                self.index.add(vectors[start:start + chunk_size])
+        self.chunks.add_many(ids.tolist(), docs)
+        return ids
+
+    def save(self):
+        """
+        Commit chunks and write the index (atomically, readers never see a partial file).
+        """
+        self.chunks.commit()
+        index_file = os.path.join(self.index_path, INDEX_FILE)
+        faiss.write_index(self.index, index_file + ".tmp")
+        os.replace(index_file + ".tmp", index_file)
+
+    def vectors(self, ids: list) -> dict:
+        """
+        Returns id -> stored vector (approximate for PQ indexes), ids that can't be reconstructed are skipped.
+        """
+        vectors = {}
+        for chunk_id in ids:
+            try:
+                vectors[int(chunk_id)] = self.index.reconstruct(int(chunk_id))
+            except RuntimeError:
+                pass
+        return vectors
+
+    def search(self, vector, k: int = 4) -> list:
+        """
+        Returns [(chunk id, score), ...] of the k nearest vectors.
+        """
+        scores, ids = self.index.search(np.asarray([vector], dtype='float32'), k)
+        return [(int(i), float(score)) for i, score in zip(ids[0], scores[0]) if i != -1]
+
+    def similarity_search_by_vector(self, vector, k: int = 4) -> list:
+        return self.chunks.get([chunk_id for chunk_id, _ in self.search(vector, k)])
+
+    def similarity_search(self, query: str, embedding, k: int = 4) -> list:
+        return self.similarity_search_by_vector(embedding.embed_query(query), k)
@@ -0,0 +1,84 @@
+from config import llm_cfg
+
+# Relevance of a chunk for explaining code, by chunk type
+CHUNK_TYPE_WEIGHTS = {
+    'class_specifier': 1.0,
+    'struct_specifier': 1.0,
+    'function_definition': 0.8,
+    'function_declaration': 0.8,
+    'enum_specifier': 0.5,
+    'type_definition': 0.5,
+}
+GRAPH_WEIGHT = 1.0
+SIMILARITY_WEIGHT = 1.0
+TYPE_WEIGHT = 0.3
+
+
+def estimate_tokens(text: str, chars_per_token: float = None) -> int:
+    """
+    Approximate number of tokens of a text (config CHARS_PER_TOKEN, default 3.5 for code).
+    """
+    chars_per_token = chars_per_token or llm_cfg.get("CHARS_PER_TOKEN", 3.5)
+    return int(len(text) / chars_per_token) + 1
+
+
+def group_key(metadata: dict) -> tuple:
+    """
+    Chunks split by split_large_chunk share the file and position of their node.
+    """
+    return metadata['file_path'], tuple(metadata['start_point']), tuple(metadata['end_point'])
+
+
+def chunk_score(distance: int, similarity: float, chunk_type: str) -> float:
+    """
+    Higher for chunks close in the symbol graph, similar to the query and of a useful type.
+    """
+    return (GRAPH_WEIGHT / (1 + distance)
+            + SIMILARITY_WEIGHT * similarity
+            + TYPE_WEIGHT * CHUNK_TYPE_WEIGHTS.get(chunk_type, 0.0))
+
+
+def chunk_header(metadata: dict, parts: int) -> str:
+    name = metadata.get('class') or ', '.join(metadata.get('defined_functions', []))
+    header = f"// {metadata['file_path']}:{metadata['start_point'][0] + 1}-{metadata['end_point'][0] + 1} " \
+             f"{metadata['type']}"
+    if name:
+        header += f" {name}"
+    if parts != metadata.get('split_total', 1):
+        header += f" (parts {parts}/{metadata['split_total']})"
+    return header
+
+
+def assemble_context(candidates: list, token_budget: int = None) -> str:
+    """
+    Build the prompt context from (chunk, graph distance, query similarity) candidates.
+    Split chunks are put back together, then the best scored ones are packed greedily
+    into token_budget (config CONTEXT_TOKENS, default 4096).
+    Selected chunks are written in file and line order, the result only depends on the candidates.
+    """
+    token_budget = token_budget or llm_cfg.get("CONTEXT_TOKENS", 4096)
+
+    groups = {}
+    for chunk, distance, similarity in candidates:
+        group = groups.setdefault(group_key(chunk.metadata), {"parts": {}, "distance": distance,
+                                                              "similarity": similarity})
+        group["parts"].setdefault(chunk.metadata.get('chunk_index', 0), chunk)
+        group["distance"] = min(group["distance"], distance)
+        group["similarity"] = max(group["similarity"], similarity)
+
+    blocks = []
+    for key, group in groups.items():
+        parts = [group["parts"][i] for i in sorted(group["parts"])]
+        text = chunk_header(parts[0].metadata, len(parts)) + "\n" + "\n".join(p.page_content for p in parts)
+        score = chunk_score(group["distance"], group["similarity"], parts[0].metadata['type'])
+        blocks.append((key, score, text))
+
+    selected = []
+    used_tokens = 0
+    for key, score, text in sorted(blocks, key=lambda b: (-b[1], b[0])):
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens <= token_budget:
+            selected.append((key, text))
+            used_tokens += tokens
+
+    return "\n\n".join(text for key, text in sorted(selected))
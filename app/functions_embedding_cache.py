@@ -0,0 +1,229 @@
+from bisect import bisect_right
+import hashlib
+import json
+import numpy as np
+import os
+import re
+
+KEY_SIZE = 32  # SHA-256 digest
+# Segments merged into one above this count, bounds the files opened by a run
+MAX_SEGMENTS = 64
+
+
+def content_key(text: str) -> str:
+    """
+    Cache key of a text, same as the `hash` metadata set by create_chunk.
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache content hash -> float32 vector, one set of files per model:
+    <model>.<base>.keys.npy (N x 32 digests), <model>.<base>.vectors.npy (N x dim) of the compacted entries
+    and <model>.<base>.used.npy (last use of all entries), one <model>.<segment>.keys/vectors.npy pair per save
+    that added entries. <model>.segments.json lists the base and the segments, it is written last so that
+    an interrupted save or compaction leaves the previous files in use.
+    Vectors are memory mapped, only the requested rows are read.
+    A save only writes the new entries; the files are compacted under a new base when the cache is larger
+    than max_size_mb and the least recently used entries are dropped.
+    """
+
+    def __init__(self, cache_path: str, model_name: str, max_size_mb: int = 1024):
+        self.cache_path = cache_path
+        self.max_size_mb = max_size_mb
+        self.prefix = os.path.join(cache_path, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+        self.segments_file = f"{self.prefix}.segments.json"
+
+        self._base = None
+        self._rows = {}
+        # Memory mapped vectors of the compacted entries then of each segment, first row of each
+        self._blocks = []
+        self._starts = []
+        self._segments = []
+        self._used = np.zeros(0, dtype='int64')
+        self._new_keys = []
+        self._new_vectors = []
+        segments = []
+        if os.path.exists(self.segments_file):
+            with open(self.segments_file, 'r') as f:
+                manifest = json.load(f)
+            # A plain list: written before the compacted files were versioned
+            if isinstance(manifest, list):
+                manifest = {"base": None, "segments": manifest}
+            self._base = manifest["base"]
+            segments = manifest["segments"]
+        files = self._segment_files()
+        if os.path.exists(files["keys"]) and os.path.exists(files["vectors"]):
+            self._load_block(None)
+        for segment in segments:
+            self._load_block(segment)
+        if os.path.exists(files["used"]):
+            # Last uses may lag behind the segments after an interrupted save
+            used = np.load(files["used"])[:len(self._rows)]
+            self._used[:len(used)] = used
+        # Entries read or added by this run are the most recent ones
+        self._generation = int(self._used.max()) + 1 if len(self._used) else 1
+
+    def _segment_files(self, segment: str = None) -> dict:
+        if segment is None:
+            # Compacted entries, unversioned files when the cache was never compacted
+            base = f".{self._base}" if self._base else ""
+            return {name: f"{self.prefix}{base}.{name}.npy" for name in ("keys", "vectors", "used")}
+        return {name: f"{self.prefix}.{segment}.{name}.npy" for name in ("keys", "vectors")}
+
+    def _load_block(self, segment: str = None):
+        files = self._segment_files(segment)
+        keys = np.load(files["keys"])
+        start = len(self._rows)
+        self._starts.append(start)
+        self._blocks.append(np.load(files["vectors"], mmap_mode='r'))
+        self._rows.update((key.tobytes(), start + row) for row, key in enumerate(keys))
+        self._used = np.concatenate([self._used, np.zeros(len(keys), dtype='int64')])
+        if segment is not None:
+            self._segments.append(segment)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, key: str):
+        """
+        Returns the cached vector of a content hash, or None.
+        """
+        row = self._rows.get(bytes.fromhex(key))
+        if row is None:
+            return None
+        if row < len(self._used):
+            self._used[row] = self._generation
+            block = bisect_right(self._starts, row) - 1
+            return np.array(self._blocks[block][row - self._starts[block]])
+        return self._new_vectors[row - len(self._used)]
+
+    def put(self, key: str, vector):
+        digest = bytes.fromhex(key)
+        if digest in self._rows:
+            return
+        self._rows[digest] = len(self._used) + len(self._new_keys)
+        self._new_keys.append(digest)
+        self._new_vectors.append(np.asarray(vector, dtype='float32'))
+
+    def save(self):
+        """
+        Write the new entries as a segment and the last uses, evicting least recently used entries
+        above max_size_mb (the cache is then compacted).
+        """
+        if not self._new_keys and not self._blocks:
+            return
+        dim = self._blocks[0].shape[1] if self._blocks else len(self._new_vectors[0])
+        used = np.concatenate([self._used, np.full(len(self._new_keys), self._generation, dtype='int64')])
+        os.makedirs(self.cache_path, exist_ok=True)
+
+        max_entries = int(self.max_size_mb * 2**20 // (dim * 4 + KEY_SIZE + 8))
+        if len(used) > max_entries:
+            # Stable sort, among entries of the same age the first added are evicted first
+            self._compact(used, np.sort(np.argsort(used, kind='stable')[len(used) - max_entries:]), dim)
+            return
+
+        if self._new_keys:
+            segment = self._merged_segment() if len(self._segments) >= MAX_SEGMENTS else None
+            if segment is None:
+                segment = f"segment{int(self._segments[-1][7:]) + 1 if self._segments else 1:06d}"
+                self._write_block(segment, self._new_keys, np.stack(self._new_vectors))
+                self._starts.append(len(self._used))
+                self._blocks.append(np.load(self._segment_files(segment)["vectors"], mmap_mode='r'))
+                self._segments.append(segment)
+            print(f"Embedding cache saved: {len(self._new_keys)} vectors added, {len(used)} cached.")
+        self._write(self._segment_files()["used"], used)
+        self._write_segments()
+        self._used = used
+        self._new_keys = []
+        self._new_vectors = []
+
+    def _merged_segment(self) -> str:
+        """
+        Merge the segments and the new entries into one segment, the compacted entries are not rewritten.
+        """
+        # Segments are the last blocks
+        first_block = len(self._blocks) - len(self._segments)
+        start = self._starts[first_block]
+        digests = list(self._rows)[start:]
+        vectors = np.concatenate([np.asarray(block) for block in self._blocks[first_block:]]
+                                 + [np.stack(self._new_vectors)])
+        old_segments = self._segments
+        segment = f"segment{int(old_segments[-1][7:]) + 1:06d}"
+        self._write_block(segment, digests, vectors)
+        del self._blocks[first_block:], self._starts[first_block:]
+        self._starts.append(start)
+        self._blocks.append(np.load(self._segment_files(segment)["vectors"], mmap_mode='r'))
+        self._segments = [segment]
+        self._write_segments()
+        self._remove_segments(old_segments)
+        return segment
+
+    def _compact(self, used, keep, dim: int):
+        """
+        Rewrite the kept entries as the compacted files of a new base and drop the segments.
+        The previous files are removed once the manifest lists the new base.
+        """
+        old_count = len(self._used)
+        old_files = self._segment_files()
+        old_segments = self._segments
+        self._base = f"compact{int(self._base[7:]) + 1 if self._base else 1:06d}"
+        files = self._segment_files()
+        keys = np.frombuffer(b"".join(self._rows), dtype='uint8').reshape(-1, KEY_SIZE)[keep]
+        # Filled block by block, the kept vectors are never all in memory
+        vectors = np.lib.format.open_memmap(files["vectors"], mode='w+', dtype='float32', shape=(len(keep), dim))
+        ends = self._starts[1:] + [old_count]
+        position = 0
+        for start, end, block in zip(self._starts, ends, self._blocks):
+            rows = keep[(keep >= start) & (keep < end)] - start
+            vectors[position:position + len(rows)] = block[rows]
+            position += len(rows)
+        new_rows = keep[keep >= old_count] - old_count
+        if len(new_rows):
+            vectors[position:] = np.stack(self._new_vectors)[new_rows]
+        vectors.flush()
+        del vectors
+
+        self._write(files["keys"], keys)
+        self._write(files["used"], used[keep])
+        self._segments = []
+        self._write_segments()
+
+        self._rows = {key.tobytes(): row for row, key in enumerate(keys)}
+        self._blocks = [np.load(files["vectors"], mmap_mode='r')]
+        self._starts = [0]
+        self._used = used[keep]
+        self._new_keys = []
+        self._new_vectors = []
+        for file_path in old_files.values():
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        self._remove_segments(old_segments)
+        print(f"Embedding cache compacted: {len(keep)} vectors, {len(used) - len(keep)} evicted.")
+
+    def _write_block(self, segment: str, digests: list, vectors):
+        files = self._segment_files(segment)
+        self._write(files["keys"], np.frombuffer(b"".join(digests), dtype='uint8').reshape(-1, KEY_SIZE))
+        self._write(files["vectors"], np.ascontiguousarray(vectors, dtype='float32'))
+
+    def _write_segments(self):
+        # Written last: base and segments files are complete once listed
+        tmp_file = self.segments_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"base": self._base, "segments": self._segments}, f)
+        os.replace(tmp_file, self.segments_file)
+
+    def _remove_segments(self, segments: list):
+        for segment in segments:
+            for file_path in self._segment_files(segment).values():
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    @staticmethod
+    def _write(file_path: str, array):
+        # Replace atomically, the previous file may still be memory mapped
+        tmp_file = file_path + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_file, file_path)
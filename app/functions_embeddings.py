@@ -1,20 +1,143 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import os
+import textwrap
+import threading
 from typing import List
 from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 
+from config import vector_cfg
+
+EMBED_BACKENDS = ("torch", "int8", "onnx")
+
+
+def normalize_snippet(text: str) -> str:
+    """
+    Same text for pasted variants of a snippet: newlines, trailing spaces, common indentation, blank borders.
+    """
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return textwrap.dedent('\n'.join(line.rstrip() for line in lines)).strip('\n')
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query embeddings keyed by the hash of the normalized query.
+    Concurrent requests for the same query wait for the first one instead of computing it again.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._vectors = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, text: str, compute):
+        """
+        Returns the cached embedding of text, calling compute(normalized text) on a miss.
+        """
+        text = normalize_snippet(text)
+        key = hashlib.sha256(text.encode()).hexdigest()
+        with self._lock:
+            if key in self._vectors:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+                return self._vectors[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                pending = self._in_flight[key] = Future()
+        if future is not None:
+            return future.result()
+
+        try:
+            vector = compute(text)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            # Cached before leaving in-flight, a new request can't miss in between
+            self._vectors[key] = vector
+            while len(self._vectors) > self.max_size:
+                self._vectors.popitem(last=False)
+            del self._in_flight[key]
+        pending.set_result(vector)
+        return vector
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "size": len(self._vectors)}
+
 
 class CustomEmbedding(Embeddings):
+    """
+    Sentence embedding model, with optional quantized CPU inference:
+    - torch: full precision model
+    - int8: linear layers dynamically quantized to int8 by torch
+    - onnx: ONNX Runtime, `onnx_file` selects a (quantized) export of the model, e.g. onnx/model_qint8_avx512.onnx
+    """
 
-    def __init__(self, model_name: str = "intfloat/e5-large-v2", device: str = "cpu"):
+    def __init__(self, model_name: str = "intfloat/e5-large-v2", device: str = "cpu", batch_size: int = 32,
+                 backend: str = None, num_threads: int = None, onnx_file: str = None, query_cache_size: int = None):
         self.model_name = model_name
         self.device = device
+        self.batch_size = batch_size
+        self.backend = backend or vector_cfg.get("EMBED_BACKEND", "torch")
+        self.num_threads = num_threads or vector_cfg.get("EMBED_THREADS", 0)
+        onnx_file = onnx_file or vector_cfg.get("EMBED_ONNX_FILE", "")
+        if self.backend not in EMBED_BACKENDS:
+            raise ValueError(f"Unknown embedding backend {self.backend}, expected one of {EMBED_BACKENDS}.")
+        if query_cache_size is None:
+            query_cache_size = vector_cfg.get("QUERY_CACHE_SIZE", 256)
+        self.query_cache = QueryCache(query_cache_size) if query_cache_size > 0 else None
+        # Vectors of a quantized model (and of each ONNX export) differ, they are cached apart
+        self.name = model_name if self.backend == "torch" else f"{model_name}-{self.backend}"
+        if self.backend == "onnx" and onnx_file:
+            self.name = f"{self.name}-{onnx_file}"
+
+        if self.num_threads:
+            # Read by torch (and OpenMP) when they start their thread pools
+            os.environ["OMP_NUM_THREADS"] = str(self.num_threads)
+            import torch
+            torch.set_num_threads(self.num_threads)
+
+        model_kwargs = {"device": self.device}
+        if self.backend == "onnx":
+            model_kwargs["backend"] = "onnx"
+            ort_kwargs = {}
+            if onnx_file:
+                ort_kwargs["file_name"] = onnx_file
+            if self.num_threads:
+                # ONNX Runtime sizes its thread pools from the session options, not from OMP_NUM_THREADS
+                import onnxruntime
+                session_options = onnxruntime.SessionOptions()
+                session_options.intra_op_num_threads = self.num_threads
+                session_options.inter_op_num_threads = 1
+                ort_kwargs["session_options"] = session_options
+            if ort_kwargs:
+                model_kwargs["model_kwargs"] = ort_kwargs
         self.model = HuggingFaceEmbeddings(
             model_name=self.model_name,
-            model_kwargs={"device": self.device}
+            model_kwargs=model_kwargs,
+            encode_kwargs={"batch_size": self.batch_size}
         )
 
+        if self.backend == "int8":
+            import torch
+            torch.quantization.quantize_dynamic(self.model._client, {torch.nn.Linear}, dtype=torch.qint8,
+                                                inplace=True)
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         return self.model.embed_documents(texts)
 
     def embed_query(self, text: str) -> List[float]:
-        return self.model.embed_query(text)
+        if self.query_cache is None:
+            return self.model.embed_query(text)
+        return list(self.query_cache.get_or_compute(text, self.model.embed_query))
@@ -0,0 +1,243 @@
+import chardet
+import codecs
+from collections import deque
+import hashlib
+import mmap
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from config import parser_cfg
+from functions_metrics import metrics
+from functions_parsing import get_parser, parse_cpp_file
+
+if parser_cfg.get("EXTRACTOR", "visitor") == "query":
+    from functions_ast_query import extract_chunks
+else:
+    from functions_ast import extract_chunks
+
+CPP_EXTENSIONS = ('.cc', '.h', '.c', '.cpp', '.hpp')
+STAGES = ('read', 'decode', 'parse', 'chunk')
+# Encoding detection only looks at the beginning of non UTF-8 files
+DETECT_PREFIX_SIZE = 64 * 1024
+# Files from this size are memory mapped instead of read
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def new_timings() -> dict:
+    """
+    Returns empty per-stage timings (seconds).
+    """
+    return dict.fromkeys(STAGES, 0.0)
+
+
+def add_timings(total: dict, timings: dict, nb_files: int = 0, nb_chunks: int = 0):
+    """
+    Accumulate per-stage timings into total, and into the ingestion metrics with the files and chunks
+    of the shard (workers time their shards, metrics are recorded by the process consuming them).
+    """
+    for stage in STAGES:
+        total[stage] += timings[stage]
+        metrics.inc("ingest_stage_seconds_total", timings[stage], stage=stage)
+    metrics.inc("ingest_files_total", nb_files)
+    metrics.inc("ingest_chunks_total", nb_chunks)
+
+
+def print_timings(timings: dict, nb_files: int, nb_chunks: int, wall_time: float):
+    """
+    Print per-stage timings report.
+    """
+    print(f"Ingestion done: {nb_files} files, {nb_chunks} chunks in {wall_time:.2f}s")
+    for stage in STAGES:
+        print(f"  {stage:<7} {timings[stage]:.2f}s")
+
+
+def list_cpp_files(folder_path: str) -> list:
+    """
+    Returns sorted list of C/C++ files under folder_path.
+    """
+    cpp_files = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if file.endswith(CPP_EXTENSIONS):
+                cpp_files.append(os.path.normpath(os.path.join(root, file)))
+    return sorted(cpp_files)
+
+
+def decode_source(data, known_encoding: str = None):
+    """
+    Returns (encoding, UTF-8 code bytes with text mode newlines) of raw source data (bytes or mmap).
+    UTF-8 is always tried first, a file may have been converted since it was indexed. When it fails,
+    known_encoding (detected for a previous version of the file) is used, otherwise the encoding is
+    detected on a prefix of the data.
+    UTF-8 data without carriage returns is returned as is, without any copy.
+    """
+    try:
+        str(data, 'utf-8')
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = known_encoding if known_encoding != 'utf-8' else None
+        if encoding is None:
+            encoding = chardet.detect(data[:DETECT_PREFIX_SIZE])['encoding']
+            if encoding is None or encoding.lower() in ('ascii', 'utf-8'):
+                # Invalid UTF-8 is past the prefix
+                encoding = 'cp1252'
+
+    if encoding == 'utf-8':
+        if data[:3] == codecs.BOM_UTF8:
+            data = data[3:]
+        if data.find(b'\r') == -1:
+            return encoding, data
+        # Same newline translation as a text mode open()
+        return encoding, bytes(data).replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    content = str(data, encoding, errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+    return encoding, content.encode('utf-8')
+
+
+def process_cpp_file(file_path: str, parser, timings: dict, known_hash: str = None, known_encoding: str = None):
+    """
+    Read, decode, parse and chunk one C/C++ file. The file is read once, through mmap for large files.
+    Returns (content hash, encoding, documents), documents is None when the content hash equals known_hash.
+    """
+    start = time.perf_counter()
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size >= MMAP_THRESHOLD else f.read()
+    try:
+        content_hash = hashlib.sha256(data).hexdigest()
+        now = time.perf_counter()
+        timings['read'] += now - start
+        start = now
+
+        if content_hash == known_hash:
+            return content_hash, known_encoding, None
+
+        encoding, code_bytes = decode_source(data, known_encoding)
+        now = time.perf_counter()
+        timings['decode'] += now - start
+        start = now
+
+        tree = parse_cpp_file(file_path, code_bytes, parser=parser)
+        now = time.perf_counter()
+        timings['parse'] += now - start
+        start = now
+
+        docs = extract_chunks(tree.root_node, code_bytes, file_path)
+        timings['chunk'] += time.perf_counter() - start
+        return content_hash, encoding, docs
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _init_worker():
+    # One parser per worker process
+    get_parser()
+
+
+def _process_shard(tasks: list):
+    """
+    Process a shard of (file_path, known_hash, known_encoding) tasks.
+    Returns ([(file_path, content_hash, encoding, documents), ...], timings).
+    """
+    parser = get_parser()
+    timings = new_timings()
+    results = []
+    for file_path, known_hash, known_encoding in tasks:
+        content_hash, encoding, docs = process_cpp_file(file_path, parser, timings, known_hash, known_encoding)
+        results.append((file_path, content_hash, encoding, docs))
+    return results, timings
+
+
+def iter_cpp_results(file_paths: list, workers: int = 1, shard_size: int = 16, known_hashes: dict = None,
+                     known_encodings: dict = None, max_pending: int = None):
+    """
+    Yield (results, timings) batches, one per shard, in file order.
+    Files whose content hash is the one in known_hashes are not parsed,
+    encodings in known_encodings are used instead of detecting them.
+    At most max_pending shards (default 2 per worker) are processed ahead of the consumer.
+    """
+    known_hashes = known_hashes or {}
+    known_encodings = known_encodings or {}
+    shards = (
+        [(file_path, known_hashes.get(file_path), known_encodings.get(file_path))
+         for file_path in file_paths[i:i + shard_size]]
+        for i in range(0, len(file_paths), shard_size)
+    )
+
+    if workers <= 1:
+        for shard in shards:
+            yield _process_shard(shard)
+        return
+
+    # Not Pool.imap: it submits every shard at once and buffers results the consumer has not taken yet
+    max_pending = max_pending or 2 * workers
+    # Spawned, not forked: the pool is started from the prefetch thread, possibly after the embedding model
+    # has started its own threads, which a forked child could deadlock on
+    with multiprocessing.get_context("spawn").Pool(processes=workers, initializer=_init_worker) as pool:
+        pending = deque()
+        for shard in shards:
+            pending.append(pool.apply_async(_process_shard, (shard,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def prefetch(iterable, size: int = 4):
+    """
+    Iterate over iterable in a background thread, at most `size` items ahead of the consumer.
+    Lets a stage (parsing) run while the consumer works on the previous items (embedding).
+    """
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            # Stops the pool of iter_cpp_results in this thread
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # Consumer stopped early (error or break), let the producer exit
+        stop.set()
+        thread.join()
+
+
+def iter_cpp_documents(file_paths: list, workers: int = 1, shard_size: int = 16):
+    """
+    Yield (documents, timings) batches, one per shard, in file order.
+    """
+    for results, timings in iter_cpp_results(file_paths, workers, shard_size):
+        yield [doc for _, _, _, docs in results for doc in docs], timings
@@ -0,0 +1,167 @@
+import numpy as np
+import re
+
+from functions_chunkstore import load_versioned, save_versioned
+
+LEXICAL_PREFIX = "lexical"
+IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+# camelCase, PascalCase, ACRONYMWord and digit boundaries
+SUBWORD_RE = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+STOP_WORDS = frozenset((
+    'auto', 'bool', 'break', 'case', 'char', 'const', 'continue', 'default', 'delete', 'do', 'double', 'else',
+    'false', 'float', 'for', 'if', 'include', 'int', 'long', 'new', 'nullptr', 'private', 'protected', 'public',
+    'return', 'short', 'static', 'std', 'this', 'true', 'unsigned', 'virtual', 'void', 'while',
+))
+
+
+def tokenize_identifiers(text: str) -> list:
+    """
+    Lowercase tokens of the identifiers of a text: each identifier and its parts split on `_` and camelCase.
+    `Gateway::executeFxEvent` -> gateway, executefxevent, execute, fx, event.
+    """
+    tokens = []
+    for identifier in IDENTIFIER_RE.findall(text):
+        lowered = identifier.lower()
+        if lowered in STOP_WORDS:
+            continue
+        tokens.append(lowered)
+        parts = [part.lower() for word in identifier.split('_') for part in SUBWORD_RE.findall(word)]
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part not in STOP_WORDS)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    BM25 index over identifier tokens of the chunks, stored next to the FAISS files as memory mapped arrays:
+    postings of term i are docs[offsets[i]:offsets[i + 1]] (document rows) with their term frequencies.
+    """
+
+    ARRAYS = ("offsets", "docs", "tfs", "chunk_ids", "doc_lengths")
+
+    def __init__(self, terms: list, offsets, docs, tfs, chunk_ids, doc_lengths, k1: float = 1.2, b: float = 0.75):
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.chunk_ids = chunk_ids
+        self.doc_lengths = doc_lengths
+        self.avg_length = float(np.mean(doc_lengths)) if len(doc_lengths) else 0.0
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def build(cls, chunks_content):
+        """
+        Build index from (chunk id, text) pairs of the chunk store.
+        """
+        postings = {}
+        chunk_ids = []
+        doc_lengths = []
+        for row, (chunk_id, text) in enumerate(chunks_content):
+            tokens = tokenize_identifiers(text)
+            chunk_ids.append(chunk_id)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        docs = np.empty(offsets[-1], dtype='int32')
+        tfs = np.empty(offsets[-1], dtype='float32')
+        for i, term in enumerate(terms):
+            term_postings = np.array(postings[term], dtype='int64').reshape(-1, 2)
+            docs[offsets[i]:offsets[i + 1]] = term_postings[:, 0]
+            tfs[offsets[i]:offsets[i + 1]] = term_postings[:, 1]
+        return cls(terms, offsets, docs, tfs, np.array(chunk_ids, dtype='int64'),
+                   np.array(doc_lengths, dtype='float32'))
+
+    def update(self, removed_ids, chunks_content):
+        """
+        New index without the removed chunk ids, plus (chunk id, text) pairs: only the added chunks are
+        tokenized, postings of the other chunks are filtered and merged as arrays.
+        """
+        added = LexicalIndex.build(chunks_content)
+        keep = ~np.isin(self.chunk_ids, np.asarray(removed_ids, dtype='int64'))
+        # Kept chunks are renumbered, added chunks come after them
+        rows = np.cumsum(keep) - 1
+        nb_kept = int(keep.sum())
+
+        terms = np.array(sorted(self.term_ids, key=self.term_ids.get), dtype=object)
+        added_terms = np.array(sorted(added.term_ids, key=added.term_ids.get), dtype=object)
+        vocabulary = np.array(sorted(set(terms) | set(added_terms)), dtype=object)
+        kept_postings = keep[self.docs]
+        term_ids = np.concatenate([
+            np.searchsorted(vocabulary, terms)[np.repeat(np.arange(len(terms)), np.diff(self.offsets))][kept_postings],
+            np.searchsorted(vocabulary, added_terms)[np.repeat(np.arange(len(added_terms)), np.diff(added.offsets))],
+        ]).astype('int64')
+        docs = np.concatenate([rows[self.docs[kept_postings]], added.docs + nb_kept]).astype('int32')
+        tfs = np.concatenate([self.tfs[kept_postings], added.tfs]).astype('float32')
+
+        # Postings by term, by row within a term (stable sort keeps them in row order)
+        order = np.argsort(term_ids, kind='stable')
+        counts = np.bincount(term_ids, minlength=len(vocabulary))
+        used = counts > 0
+        offsets = np.zeros(int(used.sum()) + 1, dtype='int64')
+        np.cumsum(counts[used], out=offsets[1:])
+        return LexicalIndex(vocabulary[used].tolist(), offsets, docs[order], tfs[order],
+                            np.concatenate([self.chunk_ids[keep], added.chunk_ids]).astype('int64'),
+                            np.concatenate([self.doc_lengths[keep], added.doc_lengths]).astype('float32'),
+                            self.k1, self.b)
+
+    def save(self, index_path: str):
+        """
+        Save index next to the FAISS files (see save_versioned).
+        """
+        save_versioned(index_path, LEXICAL_PREFIX, {name: getattr(self, name) for name in self.ARRAYS},
+                       "terms", sorted(self.term_ids, key=self.term_ids.get))
+
+    @classmethod
+    def load(cls, index_path: str):
+        """
+        Load index saved next to the FAISS files (arrays are memory mapped), returns None if there is none.
+        """
+        saved = load_versioned(index_path, LEXICAL_PREFIX, cls.ARRAYS, "terms")
+        if saved is None:
+            return None
+        terms, arrays = saved
+        return cls(terms, **arrays)
+
+    def search(self, query: str, k: int = 10) -> list:
+        """
+        Returns [(chunk id, BM25 score), ...] of the k best chunks for the identifiers of the query.
+        """
+        term_ids = {self.term_ids[t] for t in tokenize_identifiers(query) if t in self.term_ids}
+        if not term_ids or not len(self.chunk_ids):
+            return []
+        nb_docs = len(self.chunk_ids)
+        scores = np.zeros(nb_docs, dtype='float32')
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, tfs = self.docs[start:end], self.tfs[start:end]
+            idf = np.log(1 + (nb_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_length)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(int(self.chunk_ids[row]), float(scores[row])) for row in top]
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """
+    Fuse ranked lists of ids: score of an id is the sum of 1 / (k + rank) over the lists.
+    Returns ids by decreasing fused score (ties by first appearance).
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
@@ -1,62 +1,157 @@
+import faiss
 from langchain_core.documents import Document
-from langchain_community.vectorstores import FAISS
+import numpy as np
+import os
+import threading
+import time
 
-from ollama import Client
+from ollama import AsyncClient, Client
 
-from config import llm_cfg
+from config import llm_cfg, vector_cfg
+from functions_chunkstore import VectorStore
+from functions_context import assemble_context, estimate_tokens, group_key
+from functions_callgraph import CallGraph
 from functions_embeddings import CustomEmbedding
+from functions_lexical import LexicalIndex, reciprocal_rank_fusion
+from functions_metrics import SIZE_BUCKETS, metrics, span
+from functions_symbols import SymbolIndex
+from functions_vectorstore import base_index, set_search_params
 
 
-class OllamaLLM:
-    def __init__(self, model_name: str = llm_cfg['MODEL_NAME']):
-        self.client = Client(host= llm_cfg['HOST'])
-        self.model_name = model_name
-
-    def generate_answer(self, context: str, query: str):
-        prompt = f"""
-            ## Context:
+PROMPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prompts')
 
-            You are an intelligent assistant tasked with explaining a code snippet from Summit, a financial software package.
 
-            ## Objective:
+def load_prompt(file_path: str) -> str:
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
 
-            Provide a clear, high-level summary of the code. Explain its purpose, main functionalities,
-            and interactions with other components.
-            Focus on significant steps and skip trivial ones.
 
-            ## Instructions:
+class OllamaLLM:
+    """
+    Fixed instructions are sent as a system message that never changes (config SYSTEM_PROMPT_FILE),
+    and the model is kept loaded (config KEEP_ALIVE): Ollama reuses the KV cache of this prefix
+    and only prefills the query and context (config USER_PROMPT_FILE template).
+    """
 
-            - Context: Explain the context in which this code is used within Summit.
-            - Objective: Clearly state the main goal of the code.
-            - Inputs and Outputs: Describe the inputs the code accepts and the outputs it produces.
-            - Functionning: Outline the main steps or algorithms used in the code.
-            - Interactions: Describe how the code interacts with other components or services.
-            
-            ## Code snippet to analyse:
+    def __init__(self, model_name: str = llm_cfg['MODEL_NAME'], host: str = llm_cfg['HOST'],
+                 system_prompt_file: str = None, user_prompt_file: str = None, keep_alive=None):
+        self.client = Client(host= host)
+        self.async_client = AsyncClient(host=host)
+        self.model_name = model_name
+        self.system_prompt = load_prompt(system_prompt_file or llm_cfg.get("SYSTEM_PROMPT_FILE")
+                                         or os.path.join(PROMPTS_PATH, 'system.md'))
+        self.user_template = load_prompt(user_prompt_file or llm_cfg.get("USER_PROMPT_FILE")
+                                         or os.path.join(PROMPTS_PATH, 'user.md'))
+        self.keep_alive = keep_alive or llm_cfg.get("KEEP_ALIVE", "30m")
+        # Time to first token and generation speed of the last streamed answer
+        self.last_stats = {}
+
+    def build_messages(self, context: str, query: str) -> list:
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.user_template.format(query=query, context=context)},
+        ]
 
-            {query}
+    def warm_up(self):
+        """
+        Load the model and prefill the system prompt before the first request.
+        """
+        with span("llm_warm_up"):
+            self.client.chat(model=self.model_name, keep_alive=self.keep_alive, options={"num_predict": 1},
+                             messages=[{"role": "system", "content": self.system_prompt}])
 
-            ## Code Context:
+    def generate_answer(self, context: str, query: str):
+        response = self.client.chat(model=self.model_name, keep_alive=self.keep_alive,
+                                    messages=self.build_messages(context, query))
+        return response['message']['content']
 
-            {context}
+    def stream_answer(self, context: str, query: str, stop_event: threading.Event = None):
+        """
+        Yield the answer tokens as they are generated.
+        Generation stops when stop_event is set or when the generator is closed (the request is closed too).
+        """
+        with span("llm_stream") as attributes:
+            start = time.perf_counter()
+            stream = self.client.chat(model=self.model_name, stream=True, keep_alive=self.keep_alive,
+                                      messages=self.build_messages(context, query))
+            stats = new_generation_stats()
+            try:
+                for part in stream:
+                    if stop_event is not None and stop_event.is_set():
+                        stats["cancelled"] = True
+                        break
+                    update_generation_stats(stats, part, time.perf_counter() - start)
+                    if part['message']['content']:
+                        yield part['message']['content']
+            finally:
+                stream.close()
+                self.last_stats = stats
+                record_generation_stats(stats, attributes)
+
+    async def astream_answer(self, context: str, query: str):
+        """
+        Async version of stream_answer, cancelling the consuming task stops the generation.
         """
+        start = time.perf_counter()
+        stream = await self.async_client.chat(model=self.model_name, stream=True, keep_alive=self.keep_alive,
+                                              messages=self.build_messages(context, query))
+        stats = new_generation_stats()
+        try:
+            async for part in stream:
+                update_generation_stats(stats, part, time.perf_counter() - start)
+                if part['message']['content']:
+                    yield part['message']['content']
+        finally:
+            await stream.aclose()
+            self.last_stats = stats
+            record_generation_stats(stats)
+
+
+def new_generation_stats() -> dict:
+    return {"ttft_s": None, "total_s": 0.0, "tokens": 0, "tokens_per_s": 0.0, "cancelled": False}
+
+
+def record_generation_stats(stats: dict, attributes: dict = None):
+    """
+    Add the stats of a streamed answer to the metrics (and to the attributes of its trace span).
+    """
+    metrics.inc("llm_tokens_total", stats["tokens"])
+    if stats["cancelled"]:
+        metrics.inc("llm_cancelled_total")
+    if stats["ttft_s"] is not None:
+        metrics.observe("llm_ttft_seconds", stats["ttft_s"])
+    if attributes is not None:
+        attributes.update(ttft_ms=round((stats["ttft_s"] or 0.0) * 1000, 2), tokens=stats["tokens"],
+                          tokens_per_s=round(stats["tokens_per_s"], 1))
+
+
+def update_generation_stats(stats: dict, part, elapsed: float):
+    """
+    Update stats with a streamed part, `elapsed` seconds after the request was sent.
+    Token count and speed come from Ollama on the last part, counted parts until then.
+    """
+    if part['message']['content']:
+        if stats["ttft_s"] is None:
+            stats["ttft_s"] = elapsed
+        stats["tokens"] += 1
+    stats["total_s"] = elapsed
+    if part.get('done') and part.get('eval_count') and part.get('eval_duration'):
+        stats["tokens"] = part['eval_count']
+        stats["tokens_per_s"] = part['eval_count'] / (part['eval_duration'] / 1e9)
+    elif stats["ttft_s"] is not None and elapsed > stats["ttft_s"]:
+        stats["tokens_per_s"] = (stats["tokens"] - 1) / (elapsed - stats["ttft_s"])
 
-        response = self.client.chat(model=self.model_name, messages=[
-            {"role": "user", "content": prompt}
-        ])
-        return response['message']['content']
-    
 
 def similarity_search(query: str, index_path:str, embedding ,nb_results:int):
     """
     Search similar vector from user query
     """
     # Load FAISS vector store
-    index = FAISS.load_local(index_path, embedding, allow_dangerous_deserialization=True)
+    index = VectorStore.load(index_path, read_only=True)
     print('FAISS index loaded.')
 
     # Similarity search
-    results = index.similarity_search(query, k=nb_results)
+    results = index.similarity_search(query, embedding, k=nb_results)
     print('Similarity search done.')
 
     for res in results:
@@ -69,8 +164,7 @@ def get_all_chunks_from_vectorstore(index_path: str, embedding) -> list:
     """
     Returns list of all chunks from vectorstore
     """
-    vector_store = FAISS.load_local(index_path, embedding, allow_dangerous_deserialization=True)
-    return list(vector_store.docstore._dict.values())
+    return VectorStore.load(index_path, read_only=True).chunks.get_all()
 
 
 def find_contextual_chunks(base_chunks, pivot_chunk):
@@ -87,6 +181,7 @@ def find_contextual_chunks(base_chunks, pivot_chunk):
         context_chunks += [
             c for c in base_chunks
             if c.metadata['type'] == 'class_specifier' and c.metadata['class'] == class_name
+            and c != pivot_chunk
         ]
 
     # 2. Ajouter les fonctions appelées (mais pas définies dans ce chunk)
@@ -104,19 +199,205 @@ def find_contextual_chunks(base_chunks, pivot_chunk):
         and c != pivot_chunk
     ]
 
-    return list(set(context_chunks))  # supprime doublons
+    # supprime doublons (Document n'est pas hashable)
+    unique_chunks = []
+    seen = set()
+    for c in context_chunks:
+        if id(c) not in seen:
+            seen.add(id(c))
+            unique_chunks.append(c)
+    return unique_chunks
 
 
-def LLM_request(query: str, index_path: str) -> str:
+class RetrievalEngine:
+    """
+    Keep embedding model and FAISS index loaded to serve many queries, chunks are read from SQLite on demand.
+    The index is reloaded when its files change on disk.
+    """
 
-    embedding = CustomEmbedding()
+    INDEX_FILES = ("index.faiss", "chunks.sqlite", "symbols.json", "lexical_terms.json", "callgraph_symbols.json")
+
+    def __init__(self, index_path: str, embedding=None, reload_interval: float = 2.0):
+        self.index_path = index_path
+        self.embedding = embedding or CustomEmbedding()
+        self.reload_interval = reload_interval
+        self._reload_lock = threading.Lock()
+        self._vector_store = None
+        self._symbol_index = None
+        self._lexical_index = None
+        self._call_graph = None
+        self._index_mtime = None
+        self._last_check = 0.0
+        try:
+            self.reload()
+        except Exception as e:
+            # Missing or half written index: queries find nothing until a reload succeeds
+            print(f"Index load failed, retried on the next queries: {e}")
+
+    def _get_index_mtime(self):
+        return tuple(
+            os.path.getmtime(os.path.join(self.index_path, name))
+            for name in self.INDEX_FILES
+            if os.path.exists(os.path.join(self.index_path, name))
+        )
+
+    def reload(self, only_if_changed: bool = False):
+        """
+        Load index and chunk store, then swap them in for the next queries.
+        """
+        with self._reload_lock:
+            index_mtime = self._get_index_mtime()
+            if only_if_changed and index_mtime == self._index_mtime:
+                # Already reloaded by a concurrent query
+                return
+            vector_store = VectorStore.load(self.index_path, read_only=True)
+            set_search_params(vector_store.index)
+            ivf_index = base_index(vector_store.index)
+            if isinstance(ivf_index, faiss.IndexIVF) and ivf_index.direct_map.type == faiss.DirectMap.NoMap:
+                # Vectors of context candidates are reconstructed to score them, indexes built before
+                # the hash table direct map (an array direct map can't be made after removals)
+                ivf_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            symbol_index = SymbolIndex.load(self.index_path) or SymbolIndex.build(vector_store.chunks.iter_metadata())
+            lexical_index = LexicalIndex.load(self.index_path)
+            call_graph = CallGraph.load(self.index_path)
+            # Readers take a reference to the current store, a single assignment is atomic
+            self._vector_store, self._symbol_index, self._lexical_index, self._call_graph = \
+                vector_store, symbol_index, lexical_index, call_graph
+            self._index_mtime = index_mtime
+            print('FAISS index loaded.')
+
+    def maybe_reload(self):
+        """
+        Reload index if its files changed on disk (checked at most every reload_interval seconds).
+        """
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval and self._vector_store is not None:
+            return
+        self._last_check = now
+        if self._get_index_mtime() != self._index_mtime:
+            try:
+                self.reload(only_if_changed=True)
+            except Exception as e:
+                # Index may be half written, keep serving the loaded one
+                print(f"Index reload failed, keeping current index: {e}")
+
+    def warm_up(self):
+        """
+        Run a first query so model and index are ready before the first user request.
+        """
+        self.embedding.embed_query("warm up")
+        if self._vector_store is not None and self._vector_store.index.ntotal:
+            self.similarity_search("warm up", nb_results=1)
 
-    all_chunks = get_all_chunks_from_vectorstore(index_path=index_path, embedding=embedding)
-    chunk = similarity_search(query=query, index_path=index_path, embedding=embedding, nb_results=1)
+    def search(self, query: str, nb_results: int = 1) -> list:
+        """
+        Returns [(chunk id, chunk), ...] closest to the query. With HYBRID (default) and a lexical index,
+        the vector ranking is fused with the BM25 ranking of the query identifiers
+        (reciprocal rank fusion of HYBRID_CANDIDATES of each).
+        """
+        metrics.inc("queries_total")
+        with span("search", results=nb_results):
+            self.maybe_reload()
+            vector_store, lexical_index = self._vector_store, self._lexical_index
+            if vector_store is None:
+                return []
+            with span("embed_query"):
+                query_vector = self.embedding.embed_query(query)
+            if lexical_index is None or not vector_cfg.get("HYBRID", True):
+                with span("vector_search"):
+                    ids = [chunk_id for chunk_id, _ in vector_store.search(query_vector, nb_results)]
+            else:
+                nb_candidates = max(nb_results, vector_cfg.get("HYBRID_CANDIDATES", 50))
+                with span("vector_search", candidates=nb_candidates):
+                    dense = vector_store.search(query_vector, nb_candidates)
+                with span("lexical_search", candidates=nb_candidates):
+                    lexical = lexical_index.search(query, nb_candidates)
+                ids = reciprocal_rank_fusion([[chunk_id for chunk_id, _ in dense],
+                                              [chunk_id for chunk_id, _ in lexical]],
+                                             k=vector_cfg.get("RRF_K", 60))[:nb_results]
+            with span("fetch_chunks"):
+                chunks = vector_store.chunks.get_by_id(ids)
+            return [(chunk_id, chunks[chunk_id]) for chunk_id in ids if chunk_id in chunks]
+
+    def similarity_search(self, query: str, nb_results: int = 1) -> list:
+        return [chunk for _, chunk in self.search(query, nb_results)]
+
+    def lexical_search(self, query: str, nb_results: int = 10) -> list:
+        """
+        Chunks containing the identifiers of the query, by BM25 score.
+        """
+        self.maybe_reload()
+        vector_store, lexical_index = self._vector_store, self._lexical_index
+        if vector_store is None or lexical_index is None:
+            return []
+        return vector_store.chunks.get([chunk_id for chunk_id, _ in lexical_index.search(query, nb_results)])
+
+    def get_all_chunks(self) -> list:
+        self.maybe_reload()
+        return self._vector_store.chunks.get_all()
+
+    def find_contextual_chunks(self, pivot_chunk) -> list:
+        """
+        Same context as find_contextual_chunks, resolved with the symbol index.
+        """
+        vector_store, symbol_index = self._vector_store, self._symbol_index
+        if vector_store is None or symbol_index is None:
+            return []
+        return [
+            chunk
+            for chunk in vector_store.chunks.get(symbol_index.context_ids(pivot_chunk.metadata))
+            if chunk != pivot_chunk
+        ]
 
-    context = get_related_chunks(target_chunk=chunk, all_chunks=all_chunks)
+    def build_context(self, query: str, pivot_chunk, token_budget: int = None, pivot_id: int = None) -> str:
+        """
+        Context of find_contextual_chunks plus the whole chunk matched by the query, ranked by symbol
+        distance and similarity to the query, within token_budget.
+        With pivot_id, callers and callees up to CONTEXT_HOPS calls away are candidates too.
+        """
+        if self._vector_store is None or self._symbol_index is None:
+            return assemble_context([(pivot_chunk, 0, 1.0)], token_budget)
+        with span("build_context") as attributes:
+            vector_store, symbol_index, call_graph = self._vector_store, self._symbol_index, self._call_graph
+            distances = symbol_index.context_distances(pivot_chunk.metadata)
+            if call_graph is not None and pivot_id is not None:
+                for chunk_id, hops in call_graph.expand([pivot_id], hops=llm_cfg.get("CONTEXT_HOPS", 2),
+                                                     max_per_hop=llm_cfg.get("CONTEXT_HOP_CANDIDATES", 64)).items():
+                    distances[chunk_id] = min(distances.get(chunk_id, hops), hops)
+            chunks = vector_store.chunks.get_by_id(list(distances))
+            query_vector = np.asarray(self.embedding.embed_query(query), dtype='float32')
+            query_vector /= np.linalg.norm(query_vector) or 1.0
+            similarities = {
+                chunk_id: float(np.dot(vector, query_vector) / (np.linalg.norm(vector) or 1.0))
+                for chunk_id, vector in vector_store.vectors(list(chunks)).items()
+            }
+
+            # Other parts of the matched chunk come first
+            pivot_key = group_key(pivot_chunk.metadata)
+            candidates = [(pivot_chunk, 0, 1.0)]
+            for chunk_id, chunk in chunks.items():
+                distance = 0 if group_key(chunk.metadata) == pivot_key else distances[chunk_id]
+                candidates.append((chunk, distance, similarities.get(chunk_id, 0.0)))
+            context = assemble_context(candidates, token_budget)
+            attributes.update(candidates=len(candidates), tokens=estimate_tokens(context))
+        metrics.observe("context_tokens", attributes["tokens"], buckets=SIZE_BUCKETS)
+        metrics.observe("context_candidates", len(candidates), buckets=SIZE_BUCKETS)
+        return context
+
+
+def LLM_request(query: str, index_path: str, engine: RetrievalEngine = None) -> str:
+
+    if engine is None:
+        engine = RetrievalEngine(index_path)
+
+    results = engine.search(query=query, nb_results=1)
+    if not results:
+        return ""
+    chunk_id, chunk = results[-1]
+
+    context = engine.build_context(query, pivot_chunk=chunk, pivot_id=chunk_id)
 
     # llm = OllamaLLM()
     # response = llm.generate_answer(context=context, query=chunk)
     # print("LLM :\n", response)
-    return all_chunks
+    return context
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+import contextlib
+import json
+import os
+import threading
+import time
+
+from config import vector_cfg
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the size histograms (tokens, chunks)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000)
+METRICS_FORMATS = ("json", "prometheus")
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # Last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "buckets": dict(zip(self.buckets, self.counts))}
+
+
+class Metrics:
+    """
+    Counters and histograms of the process, by name and labels, e.g.
+    metrics.inc("chunks_total", 32) or metrics.observe("search_seconds", 0.004, stage="lexical").
+    Exported as JSON or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        """
+        {"counters": [...], "histograms": [...]}, each entry with its name and labels.
+        """
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [{"name": name, "labels": dict(labels), **histogram.snapshot()}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        def label_text(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in tuple(labels) + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{label_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{label_text(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def save_metrics(file_path: str = None, file_format: str = None):
+    """
+    Write the metrics of the process to file_path (config METRICS_PATH, nothing when empty),
+    as JSON or Prometheus text (config METRICS_FORMAT, default from the file extension .prom).
+    The file is replaced atomically, it can be read by a Prometheus textfile collector.
+    """
+    file_path = file_path or vector_cfg.get("METRICS_PATH", "")
+    if not file_path:
+        return
+    file_format = file_format or vector_cfg.get("METRICS_FORMAT") or \
+        ("prometheus" if file_path.endswith(".prom") else "json")
+    if file_format not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format {file_format}, expected one of {METRICS_FORMATS}.")
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        if file_format == "json":
+            json.dump(metrics.snapshot(), f, indent=2)
+        else:
+            f.write(metrics.to_prometheus())
+    os.replace(tmp_path, file_path)
+
+
+class Trace:
+    """
+    Spans of one query (name indented by nesting, start and duration in ms, attributes), in the order they started.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+
+    def begin(self, name: str, start: float) -> int:
+        # Placeholder filled by end(), keeps the spans in start order
+        self.spans.append({"span": "  " * self.depth + name, "start_ms": round((start - self.start) * 1000, 2)})
+        self.depth += 1
+        return len(self.spans) - 1
+
+    def end(self, index: int, duration: float, attributes: dict):
+        self.depth -= 1
+        self.spans[index].update(duration_ms=round(duration * 1000, 2), **attributes)
+
+
+_local = threading.local()
+
+
+def current_trace():
+    """
+    Trace started by this thread, None outside of start_trace.
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def start_trace(name: str):
+    """
+    Record the spans of this thread until the block ends, yields the Trace.
+    """
+    previous = current_trace()
+    trace = _local.trace = Trace(name)
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Time a stage: observed in the `<name>_seconds` histogram and added to the current trace, if any.
+    The yielded dict takes attributes known at the end of the stage (sizes, counts).
+    """
+    trace = current_trace()
+    start = time.perf_counter()
+    index = trace.begin(name, start) if trace is not None else None
+    try:
+        yield attributes
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe(f"{name}_seconds", duration)
+        if trace is not None:
+            trace.end(index, duration, attributes)
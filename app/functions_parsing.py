@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from functools import lru_cache
+import threading
 from tree_sitter import Language, Parser
 import os
 
@@ -5,24 +8,146 @@ from config import parser_cfg
 
 LIB_PATH = parser_cfg['BUILD_PATH']
 
-if not os.path.exists(LIB_PATH):
-    Language.build_library(
-        LIB_PATH,
-        [parser_cfg['LIB_PATH']]
-    )
+# Parser and parsed trees owned by the current thread (so by each worker process too)
+_local = threading.local()
 
-CPP_LANGUAGE = Language(LIB_PATH, 'cpp')
+
+@lru_cache(maxsize=None)
+def get_language():
+    """
+    Load C++ language once, building the library if needed.
+    """
+    if not os.path.exists(LIB_PATH):
+        Language.build_library(
+            LIB_PATH,
+            [parser_cfg['LIB_PATH']]
+        )
+    return Language(LIB_PATH, 'cpp')
 
 
-def parse_cpp_code(code: str):
+def create_parser():
     """
-    Parse C++ code and returns AST.
+    Create a parser configured for C++.
     """
     parser = Parser()
-    parser.set_language(CPP_LANGUAGE)
-    
-    tree = parser.parse(code.encode('utf8'))
-    return tree.root_node
+    parser.set_language(get_language())
+    return parser
+
+
+def get_parser():
+    """
+    Returns the parser of the current thread, created on first use.
+    """
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = create_parser()
+    return parser
+
+
+def parse_cpp_bytes(code_bytes: bytes, parser=None, old_tree=None):
+    """
+    Parse UTF-8 encoded C++ code and returns the tree.
+    An edited old_tree is reused by tree-sitter to only re-parse what changed.
+    """
+    parser = parser or get_parser()
+    if old_tree is None:
+        return parser.parse(code_bytes)
+    return parser.parse(code_bytes, old_tree)
+
+
+def parse_cpp_code(code, parser=None):
+    """
+    Parse C++ code (str or UTF-8 bytes) and returns AST.
+    """
+    code_bytes = code.encode('utf8') if isinstance(code, str) else code
+    return parse_cpp_bytes(code_bytes, parser=parser).root_node
+
+
+def _common_prefix_length(a: bytes, b: bytes, limit: int) -> int:
+    # Binary search on slice comparisons, done in C
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a: bytes, b: bytes, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _byte_to_point(code_bytes: bytes, offset: int):
+    row = code_bytes.count(b'\n', 0, offset)
+    return row, offset - (code_bytes.rfind(b'\n', 0, offset) + 1)
+
+
+def compute_edit(old_bytes: bytes, new_bytes: bytes) -> dict:
+    """
+    Single edit turning old_bytes into new_bytes (common prefix and suffix are kept), as tree.edit arguments.
+    """
+    start = _common_prefix_length(old_bytes, new_bytes, min(len(old_bytes), len(new_bytes)))
+    suffix = _common_suffix_length(old_bytes, new_bytes, min(len(old_bytes), len(new_bytes)) - start)
+    old_end = len(old_bytes) - suffix
+    new_end = len(new_bytes) - suffix
+    return {
+        "start_byte": start,
+        "old_end_byte": old_end,
+        "new_end_byte": new_end,
+        "start_point": _byte_to_point(old_bytes, start),
+        "old_end_point": _byte_to_point(old_bytes, old_end),
+        "new_end_point": _byte_to_point(new_bytes, new_end),
+    }
+
+
+def reparse_cpp_bytes(old_tree, old_bytes: bytes, new_bytes: bytes, parser=None):
+    """
+    Incrementally re-parse a slightly changed file from its previous tree.
+    """
+    old_tree.edit(**compute_edit(old_bytes, new_bytes))
+    return parse_cpp_bytes(new_bytes, parser=parser, old_tree=old_tree)
+
+
+def parse_cpp_file(file_path: str, code_bytes: bytes, parser=None, cache_size: int = None):
+    """
+    Parse a file, re-parsing incrementally from the tree kept for the same path by this thread.
+    The last `cache_size` trees are kept (config TREE_CACHE_SIZE, default 0: disabled). Only worth it
+    in long-lived processes parsing the same files again (app, watcher), not in one-shot builds.
+    """
+    if cache_size is None:
+        cache_size = parser_cfg.get("TREE_CACHE_SIZE", 0)
+    if cache_size <= 0:
+        return parse_cpp_bytes(code_bytes, parser=parser)
+
+    trees = getattr(_local, 'trees', None)
+    if trees is None:
+        trees = _local.trees = OrderedDict()
+
+    if not isinstance(code_bytes, bytes):
+        # Memory mapped sources are closed once chunked, nothing to keep
+        return parse_cpp_bytes(code_bytes, parser=parser)
+
+    cached = trees.pop(file_path, None)
+    if cached is None:
+        tree = parse_cpp_bytes(code_bytes, parser=parser)
+    elif cached[0] == code_bytes:
+        tree = cached[1]
+    else:
+        tree = reparse_cpp_bytes(cached[1], cached[0], code_bytes, parser=parser)
+
+    trees[file_path] = (code_bytes, tree)
+    while len(trees) > cache_size:
+        trees.popitem(last=False)
+    return tree
 
 
 def print_tree(node, indent=0):
@@ -35,8 +160,8 @@ def print_tree(node, indent=0):
 
 
 if __name__ == '__main__':
-    cpp_file_path = '../test/parsing_tests/finance_pricing_engine.cpp'
-    with open(cpp_file_path, 'r') as file:
+    cpp_file_path = '../test/test_parsing/finance_pricing_engine.cpp'
+    with open(cpp_file_path, 'rb') as file:
         cpp_code = file.read()
 
     root = parse_cpp_code(cpp_code)
@@ -0,0 +1,92 @@
+import json
+import os
+
+from functions_chunkstore import replace_file
+
+SYMBOLS_FILE = "symbols.json"
+FUNCTION_TYPES = ('function_definition', 'function_declaration')
+
+
+class SymbolIndex:
+    """
+    Inverted index from symbols to chunk ids, built at index time:
+    defined function -> chunks, class name -> class chunks, file path -> function chunks.
+    """
+
+    def __init__(self, functions: dict = None, classes: dict = None, files: dict = None):
+        self.functions = functions or {}
+        self.classes = classes or {}
+        self.files = files or {}
+
+    @classmethod
+    def build(cls, chunks_metadata):
+        """
+        Build index from (chunk id, metadata) pairs of the chunk store.
+        """
+        symbol_index = cls()
+        for doc_id, metadata in chunks_metadata:
+            for func in set(metadata.get('defined_functions', [])):
+                symbol_index.functions.setdefault(func, []).append(doc_id)
+            if metadata.get('type') == 'class_specifier' and metadata.get('class'):
+                symbol_index.classes.setdefault(metadata['class'], []).append(doc_id)
+            if metadata.get('type') in FUNCTION_TYPES:
+                symbol_index.files.setdefault(metadata['file_path'], []).append(doc_id)
+        return symbol_index
+
+    def update(self, removed_ids, chunks_metadata):
+        """
+        Drop the removed chunk ids and add (chunk id, metadata) pairs, ids already indexed are replaced.
+        """
+        chunks_metadata = list(chunks_metadata)
+        dropped = set(int(i) for i in removed_ids) | {doc_id for doc_id, _ in chunks_metadata}
+        added = SymbolIndex.build(chunks_metadata)
+        for mapping, added_mapping in ((self.functions, added.functions), (self.classes, added.classes),
+                                       (self.files, added.files)):
+            for key in list(mapping):
+                mapping[key] = [doc_id for doc_id in mapping[key] if doc_id not in dropped]
+                if not mapping[key]:
+                    del mapping[key]
+            for key, doc_ids in added_mapping.items():
+                mapping.setdefault(key, []).extend(doc_ids)
+        return self
+
+    def save(self, index_path: str):
+        """
+        Save index next to the FAISS files.
+        """
+        symbols = {"functions": self.functions, "classes": self.classes, "files": self.files}
+        replace_file(os.path.join(index_path, SYMBOLS_FILE), lambda f: json.dump(symbols, f), 'w')
+
+    @classmethod
+    def load(cls, index_path: str):
+        """
+        Load index saved next to the FAISS files, returns None if there is none.
+        """
+        symbols_file = os.path.join(index_path, SYMBOLS_FILE)
+        if not os.path.exists(symbols_file):
+            return None
+        with open(symbols_file, 'r') as f:
+            return cls(**json.load(f))
+
+    def context_ids(self, metadata: dict) -> list:
+        """
+        Returns ordered, deduplicated chunk ids of the context of a chunk:
+        parent class, chunks defining the called functions, other functions of the same file.
+        """
+        return list(self.context_distances(metadata))
+
+    def context_distances(self, metadata: dict) -> dict:
+        """
+        Same chunks as context_ids, with their distance to the chunk:
+        1 for the parent class and the called functions, 2 for the other functions of the file.
+        """
+        distances = {}
+        if metadata.get('class'):
+            for doc_id in self.classes.get(metadata['class'], []):
+                distances.setdefault(doc_id, 1)
+        for func in sorted(set(metadata.get('used_functions', []))):
+            for doc_id in self.functions.get(func, []):
+                distances.setdefault(doc_id, 1)
+        for doc_id in self.files.get(metadata['file_path'], []):
+            distances.setdefault(doc_id, 2)
+        return distances
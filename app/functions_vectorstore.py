@@ -1,28 +1,46 @@
-import chardet
 import faiss
 import hashlib
 import json
-from langchain_community.vectorstores import FAISS
-from langchain_community.docstore.in_memory import InMemoryDocstore
+import logging
 from langchain_community.document_loaders import PyMuPDFLoader
 import numpy as np
 import os
 from os import path
 import shutil
-from uuid import uuid4
+import time
 
-from config import vector_cfg
-from functions_ast import extract_chunks_from_ast
+from config import parser_cfg, vector_cfg
+from functions_callgraph import CallGraph
+from functions_chunkstore import VectorStore, takes_ids
+from functions_embedding_cache import EmbeddingCache, content_key
 from functions_embeddings import CustomEmbedding
-from functions_parsing import parse_cpp_code
+from functions_lexical import LexicalIndex
+from functions_metrics import metrics, save_metrics, span
+from functions_symbols import SymbolIndex
+from functions_ingestion import (CPP_EXTENSIONS, add_timings, iter_cpp_documents, iter_cpp_results,
+                                 list_cpp_files, new_timings, prefetch, print_timings)
 
+logger = logging.getLogger(__name__)
 
-def load_splits_doc(folder_path: str):
+MANIFEST_FILE = "manifest.json"
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+
+def iter_splits_doc(folder_path: str, workers: int = None):
     """
-    Returns list of splitted documents (text content + metadata)
+    Yield batches of splitted documents (text content + metadata), one per shard of files.
+    C/C++ files are sharded across `workers` processes (config WORKERS, default 1).
     """
 
-    splits = []
+    if workers is None:
+        workers = vector_cfg.get("WORKERS", 1)
+
+    compile_commands = parser_cfg.get("COMPILE_COMMANDS", "")
+    if compile_commands:
+        yield from iter_clang_splits_doc(compile_commands, workers)
+        return
+
+    cpp_files = []
 
     # Load texts
     for root, dirs, files in os.walk(folder_path):
@@ -36,18 +54,45 @@ def load_splits_doc(folder_path: str):
                 doc = loader.load()
 
             # Handle C, C++ documents
-            elif file_path.endswith(('.cc', '.h', '.c', '.cpp', '.hpp')):
-                with open(file_path, 'rb') as f:
-                    raw_data = f.read()
-                    result = chardet.detect(raw_data)
-                    encoding = result['encoding']
+            elif file_path.endswith(CPP_EXTENSIONS):
+                cpp_files.append(file_path)
+
+    start = time.perf_counter()
+    timings = new_timings()
+    nb_splits = 0
+    shard_size = 16
+    for i, (docs, shard_timings) in enumerate(prefetch(iter_cpp_documents(cpp_files, workers, shard_size),
+                                                       vector_cfg.get("PREFETCH_SHARDS", 4))):
+        add_timings(timings, shard_timings, len(cpp_files[i * shard_size:(i + 1) * shard_size]), len(docs))
+        nb_splits += len(docs)
+        yield docs
+    print_timings(timings, len(cpp_files), nb_splits, time.perf_counter() - start)
 
-                with open(file_path, 'r', encoding=encoding) as f:
-                    content = f.read()
-                    ast = parse_cpp_code(content)
-                    doc = extract_chunks_from_ast(ast, content, file_path)
-                    splits.extend(doc)
-    return splits
+
+def iter_clang_splits_doc(compile_commands: str, workers: int):
+    """
+    Yield batches of splitted documents of the translation units of a compile_commands.json, parsed by clang.
+    """
+    from functions_ast_clang_version import iter_clang_documents
+
+    start = time.perf_counter()
+    timings = new_timings()
+    nb_units = 0
+    nb_splits = 0
+    for docs, unit_timings in prefetch(iter_clang_documents(compile_commands, workers=workers),
+                                       vector_cfg.get("PREFETCH_SHARDS", 4)):
+        add_timings(timings, unit_timings, 1, len(docs))
+        nb_units += 1
+        nb_splits += len(docs)
+        yield docs
+    print_timings(timings, nb_units, nb_splits, time.perf_counter() - start)
+
+
+def load_splits_doc(folder_path: str, workers: int = None):
+    """
+    Returns list of splitted documents (text content + metadata)
+    """
+    return [split for splits in iter_splits_doc(folder_path, workers) for split in splits]
 
 
 def document_hash(document):
@@ -75,64 +120,518 @@ def save_json(json_file: str, hashes):
         json.dump(list(hashes), f)
 
 
-def build_vectorstore(folder_path: str, index_path: str, json_file: str):
+def load_manifest(index_path: str) -> dict:
     """
-    Create or update vectorstore
+    Load per-file manifest (path -> mtime, size, content hash, chunk ids) stored with the index
     """
+    manifest_file = os.path.join(index_path, MANIFEST_FILE)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    return {"next_id": 0, "files": {}}
 
-    splits = load_splits_doc(folder_path)
-    embedding = CustomEmbedding()
 
-    existing_hashes = load_existing_doc(json_file)
+def save_manifest(index_path: str, manifest: dict):
+    """
+    Save per-file manifest next to the index
+    """
+    with open(os.path.join(index_path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+
+def file_stat(file_path: str):
+    """
+    Returns (mtime, size) of a file
+    """
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_embedding_cache(index_path: str, embedding):
+    """
+    Embedding cache of the model, None if disabled (config EMBED_CACHE).
+    Stored outside the index folder (config EMBED_CACHE_PATH) so that it survives new_vector().
+    """
+    if not vector_cfg.get("EMBED_CACHE", True):
+        return None
+    cache_path = vector_cfg.get("EMBED_CACHE_PATH") or \
+        os.path.join(os.path.dirname(os.path.abspath(index_path)), "embedding_cache")
+    model_name = getattr(embedding, "name", None) or getattr(embedding, "model_name", type(embedding).__name__)
+    return EmbeddingCache(cache_path, model_name, max_size_mb=vector_cfg.get("EMBED_CACHE_SIZE_MB", 1024))
+
+
+def embed_splits(embedding, splits: list, batch_size: int = 32, sort_by_length: bool = True, cache=None):
+    """
+    Embed splits by batches, returns a float32 array with one row per split (same order).
+    Sorting by length groups texts of similar size in a batch to reduce padding.
+    Splits whose content hash is in the cache are not sent to the model (the caller saves the cache).
+    """
+
+    texts = [split.page_content for split in splits]
+    keys = [split.metadata.get("hash") or content_key(split.page_content) for split in splits]
+    vectors = None
+    order = []
+    for i, key in enumerate(keys):
+        vector = cache.get(key) if cache is not None else None
+        if vector is None:
+            order.append(i)
+            continue
+        if vectors is None:
+            vectors = np.empty((len(texts), len(vector)), dtype='float32')
+        vectors[i] = vector
+    if cache is not None:
+        metrics.inc("embed_cache_hits_total", len(texts) - len(order))
+        logger.debug(f"{len(texts) - len(order)}/{len(texts)} embeddings found in cache.")
+
+    if sort_by_length:
+        order.sort(key=lambda i: len(texts[i]))
+
+    for start in range(0, len(order), batch_size):
+        batch_ids = order[start:start + batch_size]
+        with span("embed_batch", chunks=len(batch_ids)):
+            batch_vectors = embedding.embed_documents([texts[i] for i in batch_ids])
+        metrics.inc("embedded_chunks_total", len(batch_ids))
+        if vectors is None:
+            vectors = np.empty((len(texts), len(batch_vectors[0])), dtype='float32')
+        vectors[batch_ids] = batch_vectors
+        if cache is not None:
+            for i in batch_ids:
+                cache.put(keys[i], vectors[i])
+        logger.debug(f"Embedded {min(start + batch_size, len(order))}/{len(order)} documents.")
 
-    new_embeddings = []
-    new_splits =  []
-    for split in splits:
-        doc_hash = document_hash(split)
-        if doc_hash not in existing_hashes:
-            embedding_vector = embedding.embed_query(split.page_content)
-            new_embeddings.append(embedding_vector)
-            new_splits.append(split)
-            existing_hashes.add(doc_hash)
-            print('New document processed.')
+    return vectors
+
+
+def index_params(**params) -> dict:
+    """
+    FAISS index parameters, from config unless given.
+    """
+    defaults = {
+        "index_type": vector_cfg.get("INDEX_TYPE", "flat"),
+        "nlist": vector_cfg.get("NLIST", 1024),
+        "pq_m": vector_cfg.get("PQ_M", 64),
+        "pq_nbits": vector_cfg.get("PQ_NBITS", 8),
+        "hnsw_m": vector_cfg.get("HNSW_M", 32),
+        "ef_construction": vector_cfg.get("EF_CONSTRUCTION", 40),
+        "train_size": vector_cfg.get("TRAIN_SIZE", 100000),
+    }
+    defaults.update(params)
+    return defaults
+
+
+def create_index(dim: int, vectors=None, id_mapped: bool = False, **params):
+    """
+    Create an inner product FAISS index: flat (exact), ivf_flat, ivf_pq or hnsw.
+    IVF indexes are trained on a random sample of `vectors`, without enough of them a flat index is created.
+    With id_mapped, flat and HNSW indexes are wrapped in an ID map to take chunk ids. IVF indexes store ids in
+    their lists and are never wrapped (the ID map's remove_ids would renumber the IVF ids).
+    """
+
+    params = index_params(**params)
+    index_type = params["index_type"]
+    nb_vectors = 0 if vectors is None else len(vectors)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["ef_construction"]
+
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        # Trained on at most train_size vectors: fewer lists than training vectors,
+        # and at least 2^nbits of them to train PQ codebooks
+        nb_train = min(nb_vectors, params["train_size"])
+        nlist = min(params["nlist"], max(1, nb_train // 39))
+        min_train = 2 ** params["pq_nbits"] if index_type == "ivf_pq" else nlist
+        if nb_train < max(min_train, 1):
+            print(f"Not enough vectors to train {index_type} ({nb_train}), flat index created.")
+            return create_index(dim, vectors, id_mapped, **dict(params, index_type="flat"))
+
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
         else:
-            print('Document already exists.')
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["pq_m"], params["pq_nbits"],
+                                     faiss.METRIC_INNER_PRODUCT)
+        sample = vectors
+        if nb_vectors > nb_train:
+            sample = vectors[np.random.default_rng(0).choice(nb_vectors, nb_train, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype='float32'))
+        print(f"{index_type} index trained on {len(sample)} vectors ({nlist} lists).")
+        # Vectors reconstructed by id, kept by remove_ids, saved with the index
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
 
-    if os.path.exists(index_path):
-        vector_store = FAISS.load_local(index_path, embedding, allow_dangerous_deserialization=True)
-        print('Vector store already exists.')
-    
     else:
-        dim = len(new_embeddings[0]) if new_embeddings else 1024
-        index = faiss.IndexFlatIP(dim)
-        vector_store = FAISS(index=index,
-                             docstore=InMemoryDocstore({}),
-                             embedding_function=embedding,
-                             index_to_docstore_id={})
-        print('New vector store created.')
-
-    if new_embeddings:
-        new_embeddings = np.array(new_embeddings).astype('float32')
-        vector_store.index.add(new_embeddings)
-        for split in new_splits:
-            new_uuid = str(uuid4())
-            vector_store.docstore.add({new_uuid: split})
-            vector_store.index_to_docstore_id[vector_store.index.ntotal - len(new_splits) + new_splits.index(split)] = new_uuid
-
-        vector_store.save_local(index_path)
+        raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}.")
+
+    if id_mapped:
+        index = faiss.IndexIDMap2(index)
+    return index
+
+
+def base_index(index):
+    """
+    Returns the index wrapped by an ID map, or the index itself.
+    """
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_ids(index) -> np.ndarray:
+    """
+    Ids of the vectors of an index added with ids.
+    """
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(index.id_map)
+    lists = index.invlists
+    return np.concatenate([np.zeros(0, dtype='int64')] + [
+        faiss.rev_swig_ptr(lists.get_ids(i), lists.list_size(i)).copy()
+        for i in range(index.nlist) if lists.list_size(i)
+    ])
+
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """
+    Set query time knobs: lists visited by IVF indexes, candidate list size of HNSW.
+    """
+    nprobe = nprobe or vector_cfg.get("NPROBE", 16)
+    ef_search = ef_search or vector_cfg.get("EF_SEARCH", 64)
+    index = base_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+
+def remove_vectors(vector_store, ids: list):
+    """
+    Remove vectors and their chunks from an ID-mapped vector store.
+    """
+    if not ids:
+        return
+    if isinstance(base_index(vector_store.index), faiss.IndexHNSW):
+        raise ValueError("HNSW indexes do not support removal, rebuild it with new_vector().")
+    vector_store.index.remove_ids(np.array(ids, dtype='int64'))
+    vector_store.chunks.delete(ids)
+
+
+class IndexBuilder:
+    """
+    Embed and add splits to the vector store by batches of PIPELINE_BATCH_SIZE chunks, so that memory
+    does not grow with the corpus. The store is created on the first batch (a new IVF index waits for
+    TRAIN_SIZE chunks to be trained on).
+    """
+
+    def __init__(self, index_path: str, embedding, id_mapped: bool = False):
+        self.index_path = index_path
+        self.embedding = embedding
+        self.id_mapped = id_mapped
+        self.embed_batch_size = vector_cfg.get("EMBED_BATCH_SIZE", 32)
+        self.batch_size = vector_cfg.get("PIPELINE_BATCH_SIZE", 1024)
+        self.checkpoint_size = vector_cfg.get("CHECKPOINT_SIZE", 20000)
+        self.cache = get_embedding_cache(index_path, embedding)
+        self.vector_store = None
+        if VectorStore.exists(index_path):
+            self.vector_store = VectorStore.load(index_path)
+            index = self.vector_store.index
+            if id_mapped and (not takes_ids(index) or index is not base_index(index)
+                              and isinstance(base_index(index), faiss.IndexIVF)):
+                # IVF in an ID map: ids were mixed up by removals
+                raise ValueError(f"Index at {index_path} is not ID-mapped, rebuild it with new_vector().")
+            if not id_mapped and takes_ids(index):
+                ids = self.vector_store.chunks.ids()
+                if len(ids) and ids[-1] != len(ids) - 1:
+                    # Ids left sparse by incremental updates, new ids counted from ntotal would collide
+                    raise ValueError(f"Index at {index_path} was built with INCREMENTAL, keep it enabled "
+                                     f"or rebuild the index with new_vector().")
+            print('Vector store already exists.')
+        hnsw = index_params()["index_type"] == "hnsw" if self.vector_store is None \
+            else isinstance(base_index(self.vector_store.index), faiss.IndexHNSW)
+        if id_mapped and hnsw:
+            # Checked before anything is embedded: vectors of changed files could not be removed
+            raise ValueError("HNSW indexes do not support removal, use INCREMENTAL with another INDEX_TYPE.")
+        self.pending = []
+        self.pending_ids = []
+        self.nb_added = 0
+        self.since_checkpoint = 0
+
+    def _flush_size(self) -> int:
+        if self.vector_store is None and index_params()["index_type"] in ("ivf_flat", "ivf_pq"):
+            return max(self.batch_size, index_params()["train_size"])
+        return self.batch_size
+
+    def add(self, splits: list, ids: list = None):
+        """
+        Queue splits (with their ids for ID-mapped indexes), embedded and added once a batch is full.
+        """
+        self.pending.extend(splits)
+        if ids is not None:
+            self.pending_ids.extend(ids)
+        if len(self.pending) >= self._flush_size():
+            self.flush()
+
+    def flush(self):
+        """
+        Embed and add the queued splits.
+        """
+        if not self.pending:
+            return
+        splits = self.pending
+        vectors = embed_splits(self.embedding, splits, batch_size=self.embed_batch_size,
+                               sort_by_length=vector_cfg.get("SORT_BY_LENGTH", True), cache=self.cache)
+        if self.vector_store is None:
+            self.vector_store = VectorStore.create(
+                self.index_path, create_index(vectors.shape[1], vectors, id_mapped=self.id_mapped)
+            )
+            print('New vector store created.')
+
+        with span("index_add", chunks=len(splits)):
+            self.vector_store.add(vectors, splits, ids=self.pending_ids if self.id_mapped else None,
+                                  chunk_size=vector_cfg.get("ADD_CHUNK_SIZE", 4096))
+
+        self.nb_added += len(splits)
+        self.since_checkpoint += len(splits)
+        self.pending = []
+        self.pending_ids = []
+
+    def remove(self, ids: list):
+        if self.vector_store is not None:
+            remove_vectors(self.vector_store, ids)
+
+    def remove_from(self, first_id: int):
+        """
+        Remove vectors with an id >= first_id, added after the last saved manifest by an interrupted build.
+        """
+        if self.vector_store is None or not self.vector_store.index.ntotal:
+            return
+        ids = index_ids(self.vector_store.index)
+        orphan_ids = ids[ids >= first_id].tolist()
+        if orphan_ids:
+            remove_vectors(self.vector_store, orphan_ids)
+            print(f"{len(orphan_ids)} vectors of an interrupted build removed.")
+
+    def checkpoint_due(self) -> bool:
+        return self.since_checkpoint >= self.checkpoint_size
+
+    def save(self):
+        """
+        Add queued splits and save the store: everything queued so far is on disk.
+        """
+        self.flush()
+        if self.vector_store is None:
+            return
+        with span("checkpoint"):
+            self.vector_store.save()
+            if self.cache is not None:
+                self.cache.save()
+        self.since_checkpoint = 0
+        print(f"Checkpoint: {self.vector_store.index.ntotal} vectors saved.")
+
+    def finish(self):
+        """
+        Save the store and bring its symbol, lexical and call graph indexes up to date.
+        """
+        if self.vector_store is None and not self.pending:
+            # Nothing to index, empty store
+            self.vector_store = VectorStore.create(self.index_path, create_index(1024, id_mapped=self.id_mapped))
+        self.save()
+        update_derived_indexes(self.vector_store.chunks, self.index_path)
+
+
+def update_derived_indexes(chunks, index_path: str):
+    """
+    Update symbol, lexical and call graph indexes for the chunks added or removed since they were saved.
+    The lexical index is saved last, its chunk ids tell which chunks are indexed: symbol and lexical
+    postings are only updated for the difference. The call graph resolves calls over the whole store, it is
+    rebuilt once more than CALLGRAPH_STALE_RATIO of the chunks changed since its build (until then, calls
+    of new chunks are missing and removed chunks are skipped when their context is read).
+    """
+    store_ids = chunks.ids()
+    symbol_index = SymbolIndex.load(index_path)
+    lexical_index = LexicalIndex.load(index_path)
+    if symbol_index is None or lexical_index is None:
+        removed_ids, added_ids = None, store_ids
+    else:
+        removed_ids = np.setdiff1d(lexical_index.chunk_ids, store_ids)
+        added_ids = np.setdiff1d(store_ids, lexical_index.chunk_ids)
+
+    call_graph = CallGraph.load(index_path)
+    stale = len(store_ids) if call_graph is None else len(np.setxor1d(call_graph.chunk_ids, store_ids))
+    if call_graph is None or stale > vector_cfg.get("CALLGRAPH_STALE_RATIO", 0.05) * len(store_ids):
+        with span("callgraph_build", stale=stale):
+            CallGraph.build(chunks.iter_metadata()).save(index_path)
+
+    if removed_ids is None:
+        with span("symbol_index_build"):
+            SymbolIndex.build(chunks.iter_metadata()).save(index_path)
+        with span("lexical_index_build"):
+            LexicalIndex.build(chunks.iter_content()).save(index_path)
+    elif len(removed_ids) or len(added_ids):
+        with span("symbol_index_update", removed=len(removed_ids), added=len(added_ids)):
+            symbol_index.update(removed_ids.tolist(), chunks.iter_metadata(added_ids.tolist())).save(index_path)
+        with span("lexical_index_update", removed=len(removed_ids), added=len(added_ids)):
+            lexical_index.update(removed_ids, chunks.iter_content(added_ids.tolist())).save(index_path)
+    logger.debug(f"Derived indexes updated: {len(added_ids)} chunks added, "
+                 f"{0 if removed_ids is None else len(removed_ids)} removed, call graph {stale} stale.")
+
+
+def build_vectorstore_incremental(folder_path: str, index_path: str, embedding=None):
+    """
+    Update vectorstore from the per-file manifest: unchanged files are skipped before parsing,
+    vectors of changed or deleted files are removed.
+    Files are streamed through parse -> chunk -> embed -> add, the index and manifest are saved every
+    CHECKPOINT_SIZE chunks. An interrupted build resumes from the last checkpoint.
+    """
+
+    embedding = embedding or CustomEmbedding(batch_size=vector_cfg.get("EMBED_BATCH_SIZE", 32))
+    manifest = load_manifest(index_path)
+    files = manifest["files"]
+    builder = IndexBuilder(index_path, embedding, id_mapped=True)
+    builder.remove_from(manifest["next_id"])
+
+    cpp_files = list_cpp_files(folder_path)
+    deleted = set(files) - set(cpp_files)
+    stats = {}
+    candidates = []
+    for file_path in cpp_files:
+        stats[file_path] = file_stat(file_path)
+        entry = files.get(file_path)
+        if entry is None or (entry["mtime"], entry["size"]) != stats[file_path]:
+            candidates.append(file_path)
+    print(f"{len(candidates)} files to check, {len(deleted)} deleted, "
+          f"{len(cpp_files) - len(candidates)} unchanged.")
+
+    nb_stale = 0
+    for file_path in deleted:
+        stale_ids = files.pop(file_path)["chunk_ids"]
+        builder.remove(stale_ids)
+        nb_stale += len(stale_ids)
+
+    start = time.perf_counter()
+    timings = new_timings()
+    known_hashes = {file_path: files[file_path]["hash"] for file_path in candidates if file_path in files}
+    known_encodings = {file_path: files[file_path].get("encoding") for file_path in candidates if file_path in files}
+    results_iter = iter_cpp_results(candidates, workers=vector_cfg.get("WORKERS", 1),
+                                    known_hashes=known_hashes, known_encodings=known_encodings)
+    for results, shard_timings in prefetch(results_iter, vector_cfg.get("PREFETCH_SHARDS", 4)):
+        add_timings(timings, shard_timings, len(results), sum(len(docs) for _, _, _, docs in results if docs))
+        for file_path, content_hash, encoding, docs in results:
+            mtime, size = stats[file_path]
+            if docs is None:
+                # Touched but same content
+                files[file_path].update({"mtime": mtime, "size": size})
+                continue
+            if file_path in files:
+                stale_ids = files[file_path]["chunk_ids"]
+                builder.remove(stale_ids)
+                nb_stale += len(stale_ids)
+            seen = set()
+            new_splits = []
+            for doc in docs:
+                if doc.metadata["hash"] not in seen:
+                    seen.add(doc.metadata["hash"])
+                    new_splits.append(doc)
+            ids = list(range(manifest["next_id"], manifest["next_id"] + len(new_splits)))
+            manifest["next_id"] += len(new_splits)
+            files[file_path] = {"mtime": mtime, "size": size, "hash": content_hash, "encoding": encoding,
+                                "chunk_ids": ids}
+            builder.add(new_splits, ids)
+
+        if builder.checkpoint_due():
+            # Manifest last: it only lists files whose chunks are saved
+            builder.save()
+            save_manifest(index_path, manifest)
+    print_timings(timings, len(candidates), builder.nb_added + len(builder.pending), time.perf_counter() - start)
+    print(f"{nb_stale} stale vectors removed.")
+
+    if nb_stale or builder.nb_added or builder.pending or not VectorStore.exists(index_path):
+        builder.finish()
+        print('Index saved.')
+    save_manifest(index_path, manifest)
+    print(f"Index FAISS size: {builder.vector_store.index.ntotal} vector")
+    save_metrics()
+
+
+def build_vectorstore(folder_path: str, index_path: str, json_file: str, embedding=None):
+    """
+    Create or update vectorstore (embedding defaults to CustomEmbedding)
+    """
+
+    if vector_cfg.get("INCREMENTAL", False):
+        return build_vectorstore_incremental(folder_path, index_path, embedding)
+
+    embedding = embedding or CustomEmbedding(batch_size=vector_cfg.get("EMBED_BATCH_SIZE", 32))
+    builder = IndexBuilder(index_path, embedding)
+
+    existing_hashes = load_existing_doc(json_file)
+    if builder.vector_store is not None and len(builder.vector_store.chunks) != len(existing_hashes):
+        # Interrupted between a checkpoint and the hashes file: hash the chunks already stored
+        existing_hashes = {hashlib.sha256(text.encode('utf-8')).hexdigest()
+                           for _, text in builder.vector_store.chunks.iter_content()}
+        save_json(json_file, existing_hashes)
+        print(f"Hashes file out of date, {len(existing_hashes)} hashes read from the chunk store.")
+
+    nb_splits = 0
+    for splits in iter_splits_doc(folder_path):
+        new_splits = []
+        for split in splits:
+            doc_hash = document_hash(split)
+            if doc_hash not in existing_hashes:
+                new_splits.append(split)
+                existing_hashes.add(doc_hash)
+        nb_splits += len(splits)
+        builder.add(new_splits)
+
+        if builder.checkpoint_due():
+            builder.save()
+            save_json(json_file, existing_hashes)
+    nb_new = builder.nb_added + len(builder.pending)
+    print(f"{nb_new} new documents, {nb_splits - nb_new} already indexed.")
+
+    if nb_new:
+        builder.finish()
         save_json(json_file, existing_hashes)
         print('New embeddings added and index saved.')
     else:
         print('No new documents to process.')
 
-    print(f"Index FAISS size: {vector_store.index.ntotal} vector")
+    if builder.vector_store is not None:
+        print(f"Index FAISS size: {builder.vector_store.index.ntotal} vector")
+    save_metrics()
+
+
+def migrate_pickled_index(index_path: str):
+    """
+    Convert an index saved by LangChain (index.faiss + pickled docstore in index.pkl) to the chunk store.
+    Only run it on indexes you built, it unpickles index.pkl.
+    """
+    from langchain_community.vectorstores import FAISS
+
+    old_store = FAISS.load_local(index_path, CustomEmbedding(), allow_dangerous_deserialization=True)
+    vector_store = VectorStore.create(index_path, old_store.index)
+    chunk_ids = list(old_store.index_to_docstore_id)
+    vector_store.chunks.add_many(chunk_ids, [old_store.docstore.search(old_store.index_to_docstore_id[i])
+                                             for i in chunk_ids])
+    vector_store.save()
+    SymbolIndex.build(vector_store.chunks.iter_metadata()).save(index_path)
+    LexicalIndex.build(vector_store.chunks.iter_content()).save(index_path)
+    CallGraph.build(vector_store.chunks.iter_metadata()).save(index_path)
+    os.remove(os.path.join(index_path, "index.pkl"))
+    print(f"{len(vector_store.chunks)} chunks migrated.")
 
 
 def new_vector():
-    if os.path.exists(vector_cfg["INDEX_PATH"]) and os.path.exists( vector_cfg["JSON_PATH"]):
+    if os.path.exists(vector_cfg["INDEX_PATH"]):
         shutil.rmtree(vector_cfg["INDEX_PATH"])
+    if os.path.exists(vector_cfg["JSON_PATH"]):
         os.remove(vector_cfg["JSON_PATH"])
 
     build_vectorstore(vector_cfg["DOCS_PATH"], vector_cfg["INDEX_PATH"], vector_cfg["JSON_PATH"])
 
-# new_vector()
\ No newline at end of file
+
+if __name__ == '__main__':
+    # Parsing workers are spawned and import the main module: build only under this guard
+    build_vectorstore(vector_cfg["DOCS_PATH"], vector_cfg["INDEX_PATH"], vector_cfg["JSON_PATH"])
\ No newline at end of file
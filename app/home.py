@@ -2,17 +2,57 @@ import streamlit as st
 from streamlit.components.v1 import html
 
 from config import vector_cfg
-from functions_llm_request import LLM_request
+from functions_llm_request import LLM_request, OllamaLLM, RetrievalEngine
+from functions_metrics import save_metrics, span, start_trace
 
 
 index_path = vector_cfg['INDEX_PATH']
 
+
+@st.cache_resource
+def get_engine():
+    """
+    Single retrieval engine shared by all sessions.
+    """
+    engine = RetrievalEngine(index_path)
+    engine.warm_up()
+    return engine
+
+
+@st.cache_resource
+def warm_up_llm():
+    """
+    Load the model and prefill its system prompt once, keep_alive keeps them loaded.
+    """
+    try:
+        OllamaLLM().warm_up()
+    except Exception as e:
+        print(f"LLM warm up failed: {e}")
+
+
+warm_up_llm()
 st.title('AIDoc')
 user_query = st.text_area('Enter code snippet:')
+show_trace = st.checkbox('Show trace')
 
 if st.button('Ask.'):
     if user_query:
-        response = LLM_request(query=user_query, index_path=index_path)
-        st.write(response)
+        with start_trace("query") as trace:
+            with span("request"):
+                response = LLM_request(query=user_query, index_path=index_path, engine=get_engine())
+            with st.expander('Context'):
+                st.code(response, language='cpp')
+
+            # Tokens are shown as they arrive, the Stop button of the page closes the stream
+            llm = OllamaLLM()
+            st.write_stream(llm.stream_answer(context=response, query=user_query))
+        stats = llm.last_stats
+        if stats.get("ttft_s") is not None:
+            st.caption(f"First token after {stats['ttft_s']:.2f}s, {stats['tokens']} tokens "
+                       f"at {stats['tokens_per_s']:.1f} tokens/s")
+        if show_trace:
+            with st.expander('Trace', expanded=True):
+                st.dataframe(trace.spans, use_container_width=True)
+        save_metrics()
     else:
         st.write('Type a request.')
@@ -0,0 +1,67 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Modules of the app are imported by name, as when running from the app folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for Ollama /api/chat: streams `tokens` parts after `first_token_delay`, one every `token_delay`.
+    Parts written are counted in `sent`, `finished` is set once a response ends (complete or cancelled).
+    """
+    host = None
+    tokens = 20
+    first_token_delay = 0.05
+    token_delay = 0.005
+    sent = []
+    finished = threading.Event()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        time.sleep(self.first_token_delay)
+        try:
+            for i in range(self.tokens):
+                self._send({"model": request["model"], "message": {"role": "assistant", "content": f"tok{i} "},
+                            "done": False})
+                self.sent.append(i)
+                time.sleep(self.token_delay)
+            self._send({"model": request["model"], "message": {"role": "assistant", "content": ""}, "done": True,
+                        "eval_count": self.tokens, "eval_duration": int(self.tokens * self.token_delay * 1e9)})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.finished.set()
+
+    def _send(self, part: dict):
+        self.wfile.write(json.dumps(part).encode() + b'\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ollama_stub():
+    """
+    Local stub of Ollama on a free port, yields its handler class (URL in `host`).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubOllamaHandler.sent.clear()
+    StubOllamaHandler.finished.clear()
+    StubOllamaHandler.host = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        yield StubOllamaHandler
+    finally:
+        server.shutdown()
+        server.server_close()
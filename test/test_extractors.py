@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from functions_ast import visit_tree
+from functions_ast_query import query_tree
+from functions_parsing import parse_cpp_code
+
+TEST_PATH = os.path.dirname(os.path.abspath(__file__))
+SAMPLES = sorted(
+    os.path.join(root, file)
+    for root, dirs, files in os.walk(TEST_PATH)
+    for file in files
+    if file.endswith(('.cc', '.h', '.c', '.cpp', '.hpp'))
+)
+
+TRICKY_CODE = {
+    "nested_classes": """
+class Outer {
+public:
+    class Inner {
+    public:
+        int value() const {
+            return helper(1);
+        }
+    };
+    int run() {
+        return Inner().value();
+    }
+};
+""",
+    "typedef_struct": """
+typedef struct Point {
+    int x;
+    int y;
+    int z;
+} Point;
+
+typedef struct {
+    double re;
+    double im;
+} Complex;
+""",
+    "anonymous_namespace": """
+namespace {
+int local_helper(int x) {
+    return compute(x) + 1;
+}
+}
+
+namespace outer {
+namespace {
+int hidden(int x) {
+    return local_helper(x);
+}
+}
+}
+""",
+    "chained_calls": """
+int chained(Builder &builder) {
+    auto result = builder.withName("a").withSize(2).build();
+    return std::move(result).get()->size();
+}
+""",
+}
+
+
+def chunk_signature(code_bytes: bytes, specs: list) -> list:
+    """
+    Comparable view of chunk specs.
+    """
+    return [
+        (code_bytes[s["node"].start_byte:s["node"].end_byte], s["type"], s["class"], s["namespace"],
+         s["defined"], s["used"])
+        for s in specs
+    ]
+
+
+def extract_both(code: str) -> list:
+    """
+    Chunk specs of the visitor extractor, checked to be the same as the query extractor ones.
+    """
+    code_bytes = code.encode("utf-8")
+    root = parse_cpp_code(code)
+    visitor_includes, visitor_specs = visit_tree(root, code_bytes)
+    query_includes, query_specs = query_tree(root, code_bytes)
+    assert visitor_includes == query_includes
+    assert chunk_signature(code_bytes, visitor_specs) == chunk_signature(code_bytes, query_specs)
+    return visitor_specs
+
+
+@pytest.mark.parametrize("file_path", SAMPLES, ids=lambda path: os.path.relpath(path, TEST_PATH))
+def test_samples_same_chunks(file_path):
+    with open(file_path, 'r') as f:
+        assert extract_both(f.read())
+
+
+@pytest.mark.parametrize("name", sorted(TRICKY_CODE))
+def test_tricky_code_same_chunks(name):
+    extract_both(TRICKY_CODE[name])
+
+
+def test_nested_classes():
+    specs = extract_both(TRICKY_CODE["nested_classes"])
+    assert [(s["type"], s["class"]) for s in specs] == [("class_specifier", "Outer"), ("class_specifier", "Inner")]
+    # Methods of the inner class are defined by both
+    assert specs[0]["defined"] == ["value", "run"]
+    assert specs[1]["defined"] == ["value"]
+
+
+def test_typedef_struct():
+    specs = extract_both(TRICKY_CODE["typedef_struct"])
+    assert ("struct_specifier", "Point") in [(s["type"], s["class"]) for s in specs]
+    assert [s["type"] for s in specs].count("type_definition") == 2
+
+
+def test_anonymous_namespace():
+    specs = extract_both(TRICKY_CODE["anonymous_namespace"])
+    assert [(s["defined"], s["namespace"]) for s in specs] == [
+        (["local_helper"], "(anonymous)"),
+        (["hidden"], "outer::(anonymous)"),
+    ]
+
+
+def test_chained_calls():
+    specs = extract_both(TRICKY_CODE["chained_calls"])
+    used = specs[0]["used"]
+    # Each call of the chain is recorded, outermost first
+    assert used.index('builder.withName("a").withSize(2).build') < used.index('builder.withName')
+    assert 'std::move' in used
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+import pytest
+
+from functions_llm_request import OllamaLLM
+
+
+@pytest.fixture
+def llm(ollama_stub):
+    return OllamaLLM(model_name="stub", host=ollama_stub.host)
+
+
+def expected(ollama_stub) -> str:
+    return "".join(f"tok{i} " for i in range(ollama_stub.tokens))
+
+
+def test_stream_answer(llm, ollama_stub):
+    assert "".join(llm.stream_answer("context", "query")) == expected(ollama_stub)
+
+
+def test_stream_stats(llm, ollama_stub):
+    list(llm.stream_answer("context", "query"))
+    stats = llm.last_stats
+    assert not stats["cancelled"]
+    # Counted by the final part of the stream
+    assert stats["tokens"] == ollama_stub.tokens
+    assert stats["ttft_s"] >= ollama_stub.first_token_delay
+    assert stats["total_s"] >= stats["ttft_s"]
+    assert stats["tokens_per_s"] == pytest.approx(1 / ollama_stub.token_delay)
+
+
+def test_stream_cancelled(llm, ollama_stub):
+    stop_event = threading.Event()
+    received = []
+    for token in llm.stream_answer("context", "query", stop_event=stop_event):
+        received.append(token)
+        if len(received) == 5:
+            stop_event.set()
+    assert len(received) == 5
+    assert llm.last_stats["cancelled"]
+    # The connection is closed, the server stops generating
+    assert ollama_stub.finished.wait(timeout=5)
+    assert len(ollama_stub.sent) < ollama_stub.tokens
+
+
+def test_astream_answer(llm, ollama_stub):
+    async def consume():
+        return "".join([token async for token in llm.astream_answer("context", "query")])
+
+    assert asyncio.run(consume()) == expected(ollama_stub)
+    assert llm.last_stats["tokens"] == ollama_stub.tokens
+    assert not llm.last_stats["cancelled"]